@@ -0,0 +1,103 @@
+"""
+bench_kernels.py
+计算核基准：在相同输入上比较NumPy实现与Cython实现（fast_kernels）的耗时。
+用法（项目根目录下）：
+    cythonize -i fast_kernels.pyx
+    python benchmarks/bench_kernels.py --visits 1000000
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import kernels  # noqa: E402
+
+
+def make_visits(num_visits, num_persons, num_buckets, time_interval, seed=0):
+    """
+    随机生成已排序的就诊数组（key, person, org）
+    """
+    rng = np.random.default_rng(seed)
+    bucket = rng.integers(0, num_buckets, num_visits)
+    seconds = rng.integers(0, 30 * 86400, num_visits)
+    span = 30 * 86400 + time_interval + 1
+    key = np.sort(bucket * span + seconds)
+    person = rng.integers(0, num_persons, num_visits).astype(np.int64)
+    org = key // span
+    return key, person, org
+
+
+def make_community(num_persons, num_times, num_orgs, density, seed=0):
+    """
+    随机生成社区的人员×时间、人员×机构关联矩阵（CSR）
+    """
+    rng = np.random.default_rng(seed)
+
+    def incidence(num_cols):
+        mask = rng.random((num_persons, num_cols)) < density
+        indptr = np.zeros(num_persons + 1, dtype=np.int64)
+        np.cumsum(mask.sum(axis=1), out=indptr[1:])
+        return indptr, np.nonzero(mask)[1].astype(np.int64)
+
+    t_indptr, t_indices = incidence(num_times)
+    o_indptr, o_indices = incidence(num_orgs)
+    return t_indptr, t_indices, o_indptr, o_indices
+
+
+def timeit(func, *args, repeat=3):
+    """
+    多次运行取最短耗时（秒）
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        time1 = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - time1)
+    return best
+
+
+def main(num_visits, num_persons, num_buckets, time_interval):
+    key, person, org = make_visits(
+        num_visits, num_persons, num_buckets, time_interval)
+    pos = np.arange(num_visits, dtype=np.int64)
+    end = np.searchsorted(key, key + time_interval, side='left')
+    start = np.searchsorted(key, key - time_interval, side='right')
+    left, right, orgs = kernels.py_sweep_pairs(
+        person, org, pos, start, end, 0, num_persons - 1)
+    keys = (left << 32) | right
+    order = np.lexsort((orgs, keys))
+    keys, orgs = keys[order], orgs[order]
+    counts = np.ones(len(keys), dtype=np.int64)
+    uniq_keys, _, uniq_counts = kernels.py_reduce_sorted(keys, orgs, counts)
+    community = make_community(2000, 60, 40, 0.2)
+
+    cases = [
+        ('sweep_pairs', (person, org, pos, start, end, 0, num_persons - 1)),
+        ('reduce_sorted', (keys, orgs, counts)),
+        ('pair_stats', (uniq_keys, uniq_counts)),
+        ('prune_community', community + (60, 40, 3, 10)),
+    ]
+    print('visits: {}, covisits: {}, fast kernels: {}'.format(
+        num_visits, len(keys), kernels.HAS_FAST_KERNELS))
+    print('{:<18}{:>12}{:>12}{:>10}'.format('kernel', 'numpy(s)', 'cython(s)', 'speedup'))
+    for name, args in cases:
+        py_time = timeit(getattr(kernels, 'py_' + name), *args)
+        if kernels.HAS_FAST_KERNELS:
+            fast_time = timeit(getattr(kernels, name), *args)
+            print('{:<18}{:>12.4f}{:>12.4f}{:>9.1f}x'.format(
+                name, py_time, fast_time, py_time / fast_time))
+        else:
+            print('{:<18}{:>12.4f}{:>12}{:>10}'.format(name, py_time, '-', '-'))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--visits", type=int, default=1000000, help="就诊数")
+    arg_parser.add_argument("--persons", type=int, default=200000, help="人员数")
+    arg_parser.add_argument("--buckets", type=int, default=2000, help="(就诊类型, 机构)桶数")
+    arg_parser.add_argument("--time_interval", type=int, default=900, help="时间间隔（秒）")
+    args = arg_parser.parse_args()
+    main(args.visits, args.persons, args.buckets, args.time_interval)
@@ -0,0 +1,121 @@
+"""
+bench_pairs.py
+风险对生成基准：在不同规模的模拟数据上统计编码与get_risk_pairs的
+吞吐量（行/秒）、峰值内存与植入团伙召回率。
+每个规模在独立子进程中运行，峰值内存互不影响。
+用法（项目根目录下）：
+    python benchmarks/bench_pairs.py --sizes 100000 1000000 10000000
+"""
+import sys
+import time
+import argparse
+import resource
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+
+def _rss_mb():
+    """
+    当前进程常驻内存（MB）
+    """
+    with open('/proc/self/statm') as fp:
+        pages = int(fp.read().split()[1])
+    return pages * resource.getpagesize() / 2**20
+
+
+def _peak_rss_mb():
+    """
+    当前进程峰值常驻内存（MB）
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def run_case(num_visits, seed, time_interval, min_count, min_jg_num, n_jobs,
+             gen_kwargs):
+    """
+    单个规模的基准，在子进程中运行
+    """
+    from synthetic import generate_visits, gang_recall
+    from core_encoding import VisitEncoder
+    from core_predict import MultiCardDetection
+
+    df, gangs = generate_visits(num_visits, seed=seed, **gen_kwargs)
+    rss_before = _rss_mb()
+
+    time1 = time.perf_counter()
+    encoder = VisitEncoder()
+    visits = encoder.encode(df)
+    time2 = time.perf_counter()
+    risk_pairs = MultiCardDetection.get_risk_pairs(
+        visits, time_interval,
+        min_count=min_count, min_jg_num=min_jg_num, n_jobs=n_jobs)
+    time3 = time.perf_counter()
+
+    # 风险对解码为person_id后计算召回率
+    risk_pairs.index = pd.MultiIndex.from_arrays(
+        [encoder.person_ids[risk_pairs.index.get_level_values(i)]
+         for i in range(2)])
+    pair_recall, recall = gang_recall(risk_pairs, gangs)
+    return {
+        'visits': len(df),
+        'risk_pairs': len(risk_pairs),
+        'encode_s': time2 - time1,
+        'pairs_s': time3 - time2,
+        'rows_per_s': len(df) / (time3 - time1),
+        'peak_rss_mb': _peak_rss_mb(),
+        'peak_delta_mb': _peak_rss_mb() - rss_before,
+        'pair_recall': pair_recall,
+        'gang_recall': recall
+    }
+
+
+def main(sizes, seed, time_interval, min_count, min_jg_num, n_jobs,
+         gen_kwargs, output=None):
+    rows = []
+    for size in sizes:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            row = executor.submit(
+                run_case, size, seed, time_interval, min_count, min_jg_num,
+                n_jobs, gen_kwargs).result()
+        rows.append(row)
+        print(pd.DataFrame([row]).to_string(index=False, float_format='%.3f'))
+    result = pd.DataFrame(rows)
+    print('\n' + result.to_string(index=False, float_format='%.3f'))
+    if output:
+        result.to_csv(output, index=False)
+    return result
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument(
+        "--sizes", type=float, nargs='+', default=[1e5, 1e6, 1e7],
+        help="背景就诊数")
+    arg_parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    arg_parser.add_argument("--time_interval", type=int, default=900, help="时间间隔（秒）")
+    arg_parser.add_argument("--min_count", type=int, default=3, help="最小同时出现次数")
+    arg_parser.add_argument("--min_jg_num", type=int, default=2, help="至少涉及机构数")
+    arg_parser.add_argument("--n_jobs", type=int, default=1, help="进程数")
+    arg_parser.add_argument("--skew", type=float, default=1.0, help="人员就诊频率Zipf指数")
+    arg_parser.add_argument("--num_hot_orgs", type=int, default=5, help="热点医院数")
+    arg_parser.add_argument("--hot_share", type=float, default=0.2, help="热点医院就诊占比")
+    arg_parser.add_argument("--num_gangs", type=int, default=20, help="植入团伙数")
+    arg_parser.add_argument("--gang_size", type=int, default=8, help="团伙人数")
+    arg_parser.add_argument("--output", type=str, help="结果csv路径")
+    args = arg_parser.parse_args()
+    main(
+        [int(size) for size in args.sizes], args.seed, args.time_interval,
+        args.min_count, args.min_jg_num, args.n_jobs,
+        gen_kwargs={
+            'skew': args.skew,
+            'num_hot_orgs': args.num_hot_orgs,
+            'hot_share': args.hot_share,
+            'num_gangs': args.num_gangs,
+            'gang_size': args.gang_size
+        },
+        output=args.output)
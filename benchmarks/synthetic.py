@@ -0,0 +1,133 @@
+"""
+synthetic.py
+可复现的模拟挂号数据（与sqls中select_input_data的输出列一致），用于基准测试。
+支持人员数、机构数、人员就诊频率偏斜、热点医院，以及植入的卡聚集团伙。
+"""
+import numpy as np
+import pandas as pd
+
+
+def generate_visits(
+        num_visits, num_persons=None, num_orgs=None,
+        skew=1.0, num_hot_orgs=5, hot_share=0.2,
+        num_gangs=20, gang_size=8, gang_visits=6, gang_orgs=3,
+        gang_spread=600, start_date='2021-01-01', days=30,
+        admdvs='330100', seed=0):
+    """
+    生成模拟挂号数据
+    Parameters:
+    ----------------------------------------------
+    num_visits: int, 背景就诊数（不含团伙就诊）
+    num_persons: int, 人员数，默认为num_visits/5
+    num_orgs: int, 机构数，默认为num_visits/2000（至少20）
+    skew: float, 人员就诊频率的Zipf指数，0表示均匀
+    num_hot_orgs: int, 热点医院数
+    hot_share: float, 热点医院就诊占比
+    num_gangs: int, 植入的团伙数
+    gang_size: int, 每个团伙人数
+    gang_visits: int, 每个团伙共同就诊次数
+    gang_orgs: int, 每个团伙共同就诊涉及的机构数
+    gang_spread: int, 团伙成员每次共同就诊的入院时间跨度（秒）
+    start_date: str, 开始日期
+    days: int, 天数
+    admdvs: str, 医保区划
+    seed: int, 随机种子
+
+    Returns:
+    -----------------------------------------------
+    df: pandas.DataFrame, 列为['admdvs', 'med_clinic_id', 'person_id',
+        'med_type', 'flx_med_org_id', 'adm_time', 'adm_date']
+    gangs: list of numpy.ndarray, 各团伙成员person_id
+    """
+    rng = np.random.default_rng(seed)
+    if num_persons is None:
+        num_persons = max(num_visits // 5, 10)
+    if num_orgs is None:
+        num_orgs = max(num_visits // 2000, 20)
+    num_hot_orgs = min(num_hot_orgs, num_orgs)
+
+    # 背景就诊：人员按Zipf权重抽样，热点医院占hot_share，其余机构均匀
+    weights = 1.0 / np.arange(1, num_persons + 1) ** skew
+    person = rng.choice(
+        num_persons, num_visits, p=weights / weights.sum())
+    person = rng.permutation(num_persons)[person]
+    org = rng.integers(num_hot_orgs, num_orgs, num_visits)
+    if num_hot_orgs > 0:
+        hot = rng.random(num_visits) < hot_share
+        org[hot] = rng.integers(0, num_hot_orgs, hot.sum())
+    # 入院时间集中在白天8-17点
+    seconds = rng.integers(0, days, num_visits) * 86400 \
+        + rng.integers(8 * 3600, 17 * 3600, num_visits)
+
+    # 团伙就诊：成员在同一机构、gang_spread秒内先后入院
+    gangs = []
+    gang_person, gang_org, gang_seconds = [], [], []
+    for _ in range(num_gangs):
+        members = rng.choice(num_persons, gang_size, replace=False)
+        orgs = rng.choice(num_orgs, min(gang_orgs, num_orgs), replace=False)
+        for k in range(gang_visits):
+            base = rng.integers(0, days) * 86400 \
+                + rng.integers(8 * 3600, 17 * 3600)
+            gang_person.append(members)
+            gang_org.append(np.full(gang_size, orgs[k % len(orgs)]))
+            gang_seconds.append(base + rng.integers(0, gang_spread, gang_size))
+        gangs.append(members)
+    if gangs:
+        person = np.concatenate([person] + gang_person)
+        org = np.concatenate([org] + gang_org)
+        seconds = np.concatenate([seconds] + gang_seconds)
+
+    n = len(person)
+    # 普通门诊为主，团伙就诊均为普通门诊
+    med_type = np.where(rng.random(n) < 0.9, '11', '41')
+    med_type[num_visits:] = '11'
+    adm_time = np.datetime64(start_date, 's') + seconds.astype('timedelta64[s]')
+    df = pd.DataFrame({
+        'admdvs': admdvs,
+        'med_clinic_id': _ids('C', np.arange(n), 10),
+        'person_id': _ids('P', person, 8),
+        'med_type': med_type,
+        'flx_med_org_id': _ids('H', org, 6),
+        'adm_time': pd.to_datetime(adm_time),
+    })
+    df['adm_date'] = df['adm_time'].dt.date
+    gangs = [_ids('P', members, 8) for members in gangs]
+    return df, gangs
+
+
+def gang_recall(risk_pairs, gangs):
+    """
+    植入团伙的召回率
+    Parameters:
+    ----------------------------------------------
+    risk_pairs: pandas.DataFrame, 索引为(person_id_x, person_id_y)的风险对
+    gangs: list of numpy.ndarray, generate_visits输出的团伙成员
+
+    Returns:
+    -----------------------------------------------
+    pair_recall: float, 团伙内人员对出现在风险对中的比例
+    gang_recall: float, 团伙内全部人员对均出现在风险对中的团伙比例
+    """
+    if not gangs:
+        return float('nan'), float('nan')
+    found = set(zip(
+        risk_pairs.index.get_level_values(0),
+        risk_pairs.index.get_level_values(1)))
+    num_pairs = num_found = num_gangs = 0
+    for members in gangs:
+        members = np.sort(members)
+        pairs = [
+            (members[i], members[j])
+            for i in range(len(members)) for j in range(i + 1, len(members))]
+        hits = sum(pair in found for pair in pairs)
+        num_pairs += len(pairs)
+        num_found += hits
+        num_gangs += hits == len(pairs)
+    return num_found / num_pairs, num_gangs / len(gangs)
+
+
+def _ids(prefix, codes, width):
+    """
+    整数编码转为定长字符串编号
+    """
+    return np.char.add(prefix, np.char.zfill(codes.astype(str), width))
@@ -0,0 +1,119 @@
+"""
+checkpoint_cache.py
+按内容寻址的阶段结果缓存。
+各阶段输出以NPZ保存，键为输入数据内容及该阶段所依赖参数的哈希，
+只修改下游阈值重新运行时，上游阶段直接读取缓存；
+缓存目录总大小超出上限时，按最近使用时间从旧到新删除。
+"""
+import os
+import time
+import hashlib
+
+from loguru import logger
+import numpy as np
+import pandas as pd
+
+
+class CheckpointCache:
+    """
+    阶段结果缓存，文件名为{stage}_{key}.npz，读取时更新修改时间作为最近使用时间
+    """
+    def __init__(self, path, max_size=None):
+        """
+        Parameters:
+        --------------------------------
+        path: str, 缓存目录
+        max_size: float, 缓存目录大小上限（单位：MB），为空时不限制
+        """
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """
+        由上游键及参数生成键
+        """
+        return hashlib.sha1(repr(parts).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def data_key(encoder, visits):
+        """
+        输入数据的键：编码后就诊数据（与行序无关）及编码对照表的哈希
+        Parameters:
+        --------------------------------
+        encoder: core_encoding.VisitEncoder, 编码器
+        visits: pandas.DataFrame, 编码后的就诊数据
+        """
+        columns = ['person_id', 'med_type', 'flx_med_org_id', 'adm_time', 'adm_date']
+        hashes = np.sort(
+            pd.util.hash_pandas_object(visits[columns], index=False).values)
+        digest = hashlib.sha1(hashes.tobytes())
+        for values in (encoder.person_ids, encoder.org_ids, encoder.med_types):
+            digest.update(np.asarray(values).astype(str).tobytes())
+        digest.update(str(encoder.time_origin).encode())
+        return digest.hexdigest()[:16]
+
+    def load(self, stage, key):
+        """
+        读取阶段结果，不存在时返回None
+        Returns:
+        -----------------------------------------------
+        arrays: dict of numpy.ndarray
+        """
+        file = self._file(stage, key)
+        if not os.path.exists(file):
+            return None
+        time1 = time.time()
+        with np.load(file) as data:
+            arrays = {k: data[k] for k in data.files}
+        os.utime(file)
+        logger.info('checkpoint {}: loaded from {}, elapse {:.3f}s'.format(
+            stage, file, time.time() - time1))
+        return arrays
+
+    def save(self, stage, key, arrays):
+        """
+        保存阶段结果，先写临时文件再替换，然后按大小上限清理
+        """
+        file = self._file(stage, key)
+        temp_file = '{}.{}.tmp'.format(file, os.getpid())
+        with open(temp_file, 'wb') as fp:
+            np.savez(fp, **arrays)
+        os.replace(temp_file, file)
+        logger.info('checkpoint {}: saved to {} ({:.1f}MB)'.format(
+            stage, file, os.path.getsize(file) / 2**20))
+        self._evict(keep=os.path.basename(file))
+
+    def _file(self, stage, key):
+        return os.path.join(self.path, '{}_{}.npz'.format(stage, key))
+
+    def _evict(self, keep=None):
+        """
+        缓存目录超出大小上限时，按最近使用时间从旧到新删除；
+        keep为刚写入的文件名，不删除（单个文件超出上限时也保留）
+        """
+        if not self.max_size:
+            return
+        files = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.npz'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+        files.sort()
+        total = sum(x[1] for x in files)
+        for _, size, name in files:
+            if total <= self.max_size * 2**20:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.info('checkpoint evicted: {}'.format(name))
@@ -0,0 +1,155 @@
+"""
+core_communities.py
+剪枝后社区的紧凑表示。
+各社区的人员、时间、机构顶点序号分别首尾相接存放在一维数组中，配合偏移量数组定位，
+连通性、平均度和风险分在全部社区上一次性按边表向量化计算，
+只有进入最终结果的社区才转换为列表。
+"""
+import numpy as np
+import pandas as pd
+import igraph as ig
+
+
+class CommunityRecords:
+    """
+    剪枝后的社区：persons[person_offsets[i]:person_offsets[i+1]]为第i个社区的人员，
+    时间、机构同理；顶点序号均为graph2中的序号（人员顶点序号与graph相同）
+    """
+    def __init__(self, persons, person_offsets, times, time_offsets,
+                 orgs, org_offsets, degree1, degree2, degree3):
+        self.persons = persons
+        self.person_offsets = person_offsets
+        self.times = times
+        self.time_offsets = time_offsets
+        self.orgs = orgs
+        self.org_offsets = org_offsets
+        self.degree1 = degree1
+        self.degree2 = degree2
+        self.degree3 = degree3
+        self.size = np.diff(person_offsets)
+        # 由score计算
+        self.connectivity = None
+        self.degree4 = None
+        self.scores = None
+
+    def __len__(self):
+        return len(self.size)
+
+    @classmethod
+    def from_list(cls, records):
+        """
+        由MultiCardDetection.community_pruning的输出构建
+        Parameters:
+        ----------------------------------------------
+        records: list of dict, 含persons, times, orgs, degree1, degree2, degree3
+        """
+        def pack(key):
+            values = [r[key] for r in records]
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum([len(x) for x in values], out=offsets[1:])
+            values = np.concatenate(values).astype(np.int64) \
+                if values else np.zeros(0, dtype=np.int64)
+            return values, offsets
+
+        def degree(key):
+            return np.array([r[key] for r in records], dtype=np.float64)
+
+        return cls(
+            *pack('persons'), *pack('times'), *pack('orgs'),
+            degree('degree1'), degree('degree2'), degree('degree3'))
+
+    @classmethod
+    def concat(cls, parts):
+        """
+        按顺序合并多个CommunityRecords
+        """
+        def pack(values, offsets):
+            values = [getattr(x, values) for x in parts]
+            offsets = [getattr(x, offsets) for x in parts]
+            starts = np.cumsum([0] + [x[-1] for x in offsets[:-1]])
+            offsets = np.concatenate(
+                [[0]] + [x[1:] + s for x, s in zip(offsets, starts)])
+            return np.concatenate(values), offsets.astype(np.int64)
+
+        if not parts:
+            return cls.from_list([])
+        return cls(
+            *pack('persons', 'person_offsets'),
+            *pack('times', 'time_offsets'),
+            *pack('orgs', 'org_offsets'),
+            *[np.concatenate([getattr(x, key) for x in parts])
+              for key in ('degree1', 'degree2', 'degree3')])
+
+    def score(self, g_indptr, g_indices):
+        """
+        在graph的边表上一次性计算各社区人员导出子图的连通性、平均度及风险分
+        Parameters:
+        ----------------------------------------------
+        g_indptr, g_indices: numpy.ndarray, graph的邻接矩阵（CSR，每条边正反各一次）
+
+        Returns:
+        -----------------------------------------------
+        score: numpy.ndarray, 各社区风险分
+            connectivity + (degree1 + degree2 + degree3) * 0.1 + degree4 / size
+        """
+        n = len(self)
+        vcount = len(g_indptr) - 1
+        # 各人员所在社区，社区互不相交，不在任何社区的人员为-1
+        community = np.full(vcount, -1, dtype=np.int64)
+        community[self.persons] = np.repeat(np.arange(n), self.size)
+        rows = np.repeat(np.arange(vcount), np.diff(g_indptr))
+        inside = (community[rows] >= 0) & (community[rows] == community[g_indices])
+        rows, cols = rows[inside], g_indices[inside]
+
+        # 平均度：社区内边两端各计一次
+        self.degree4 = np.bincount(community[rows], minlength=n) / self.size
+
+        # 连通性：只含社区内边的图上，社区人员同属一个连通分量
+        components = np.asarray(ig.Graph(
+            n=vcount,
+            edges=np.column_stack([rows, cols])[rows < cols].tolist()
+        ).connected_components().membership)[self.persons]
+        self.connectivity = np.zeros(n, dtype=bool)
+        nonempty = self.size > 0
+        starts = self.person_offsets[:-1][nonempty]
+        self.connectivity[nonempty] = np.minimum.reduceat(components, starts) \
+            == np.maximum.reduceat(components, starts)
+
+        self.scores = self.connectivity \
+            + (self.degree1 + self.degree2 + self.degree3) * 0.1 \
+            + self.degree4 / self.size
+        return self.scores
+
+    def to_frame(self, names, index=None):
+        """
+        转为每个社区一行的DataFrame，c_times、c_jgids、c_person_ids为顶点name列表
+        Parameters:
+        ----------------------------------------------
+        names: numpy.ndarray, graph2各顶点name
+        index: numpy.ndarray, 输出的社区序号，默认全部
+
+        Returns:
+        -----------------------------------------------
+        result: pandas.DataFrame, 索引为社区序号
+        """
+        if index is None:
+            index = np.arange(len(self))
+
+        def lists(values, offsets):
+            return [
+                names[values[offsets[i]:offsets[i+1]]].tolist() for i in index]
+
+        result = pd.DataFrame({
+            'c_times': lists(self.times, self.time_offsets),
+            'c_jgids': lists(self.orgs, self.org_offsets),
+            'c_person_ids': lists(self.persons, self.person_offsets),
+            'size': self.size[index],
+            'degree1': self.degree1[index],
+            'degree2': self.degree2[index],
+            'degree3': self.degree3[index],
+        }, index=index)
+        if self.scores is not None:
+            result['connectivity'] = self.connectivity[index]
+            result['degree4'] = self.degree4[index]
+            result['score'] = self.scores[index]
+        return result
@@ -0,0 +1,91 @@
+"""
+core_encoding.py
+就诊数据字典编码。
+person_id、flx_med_org_id、med_type编码为int32，adm_date编码为int32天数，
+adm_time编码为相对最早入院时间的int32秒数（带时区时按UTC计，解码时转回原时区）；各阶段均在编码上计算，
+字符串仅在输出最终结果时解码。
+"""
+import numpy as np
+import pandas as pd
+
+
+class VisitEncoder:
+    """
+    就诊数据编码器，保存编码与原值的对照表
+    """
+    def __init__(self):
+        self.person_ids = None
+        self.org_ids = None
+        self.med_types = None
+        self.time_origin = 0
+        # adm_time的时区，无时区时为None
+        self.tz = None
+
+    def encode(self, df):
+        """
+        就诊数据编码
+        Parameters:
+        --------------------------------
+        df: pandas.DataFrame, 含['med_clinic_id', 'person_id', 'med_type',
+            'flx_med_org_id', 'adm_time', 'adm_date']
+
+        Returns:
+        --------------------------------
+        visits: pandas.DataFrame, 列同上，除med_clinic_id外均为int32编码
+        """
+        person, self.person_ids = pd.factorize(
+            df['person_id'], sort=True, use_na_sentinel=False)
+        org, self.org_ids = pd.factorize(
+            df['flx_med_org_id'], sort=True, use_na_sentinel=False)
+        med_type, self.med_types = pd.factorize(
+            df['med_type'], sort=True, use_na_sentinel=False)
+        self.person_ids = np.asarray(self.person_ids)
+        self.org_ids = np.asarray(self.org_ids)
+        self.med_types = np.asarray(self.med_types)
+
+        adm_time = pd.to_datetime(df['adm_time'])
+        self.tz = adm_time.dt.tz
+        seconds = adm_time.values.astype('datetime64[s]').astype(np.int64)
+        self.time_origin = int(seconds.min()) if len(seconds) > 0 else 0
+        days = pd.to_datetime(df['adm_date']).values.astype(
+            'datetime64[D]').astype(np.int64)
+
+        visits = pd.DataFrame({
+            'med_clinic_id': df['med_clinic_id'].values,
+            'person_id': person.astype(np.int32),
+            'med_type': med_type.astype(np.int32),
+            'flx_med_org_id': org.astype(np.int32),
+            'adm_time': (seconds - self.time_origin).astype(np.int32),
+            'adm_date': days.astype(np.int32)
+        })
+        return visits
+
+    def decode(self, df):
+        """
+        编码列解码为原值（原地修改）
+        Parameters:
+        --------------------------------
+        df: pandas.DataFrame, 可含['person_id', 'med_type', 'flx_med_org_id',
+            'adm_time', 'adm_date']中任意列
+
+        Returns:
+        --------------------------------
+        df: pandas.DataFrame
+        """
+        if 'person_id' in df.columns:
+            df['person_id'] = self.person_ids[df['person_id'].values]
+        if 'flx_med_org_id' in df.columns:
+            df['flx_med_org_id'] = self.org_ids[df['flx_med_org_id'].values]
+        if 'med_type' in df.columns:
+            df['med_type'] = self.med_types[df['med_type'].values]
+        if 'adm_date' in df.columns:
+            df['adm_date'] = df['adm_date'].values.astype(
+                'datetime64[D]').astype(str)
+        if 'adm_time' in df.columns:
+            adm_time = pd.to_datetime(
+                (df['adm_time'].values.astype(np.int64) + self.time_origin
+                 ).astype('datetime64[s]'))
+            if self.tz is not None:
+                adm_time = adm_time.tz_localize('UTC').tz_convert(self.tz)
+            df['adm_time'] = adm_time
+        return df
@@ -0,0 +1,162 @@
+"""
+core_pair_partials.py
+按月风险对部分结果。
+滑动窗口（window_size > step_size）中同一月份会出现在多个窗口，
+各月内部的同时就诊按(人员对, 机构)统计次数后保存到本地，
+窗口的风险对由所含各月的部分结果与相邻月份之间跨月的同时就诊合并得到；
+跨月同时就诊只涉及月份边界前后time_interval内的就诊，每个窗口重新计算。
+"""
+import os
+import time
+import hashlib
+
+from loguru import logger
+import numpy as np
+import pandas as pd
+
+from core_risk_pairs import PairCounter
+
+
+class MonthlyPairPartials:
+    """
+    按月风险对部分结果，部分结果以人员、机构原值保存，不依赖各窗口的编码
+    """
+    def __init__(self, path, encoder, count_covisits, params=None):
+        """
+        Parameters:
+        --------------------------------
+        path: str, 部分结果保存目录
+        encoder: core_encoding.VisitEncoder, 当前窗口数据的编码器
+        count_covisits: callable, count_covisits(df)返回df内全部同时就诊的
+            (较小人员编码, 较大人员编码, 机构编码, 次数)，不剪枝
+        params: dict, 影响同时就诊统计的参数，计入部分结果的键
+        """
+        self.path = path
+        self.encoder = encoder
+        self.count_covisits = count_covisits
+        self.params = params or {}
+        self._person_index = None
+        self._org_index = None
+        os.makedirs(path, exist_ok=True)
+
+    def get_risk_pairs(self, df, time_interval, min_count=0, min_jg_num=0):
+        """
+        合并窗口内各月部分结果与跨月同时就诊，获取卡聚集风险对，
+        结果与MultiCardDetection.get_risk_pairs一致
+        Parameters:
+        ----------------------------------------------
+        df: pandas.DataFrame, 编码后的窗口就诊数据
+        time_interval: int, 时间间隔（秒）
+        min_count: int, 最小同时出现次数
+        min_jg_num: int, 至少涉及机构数
+
+        Returns:
+        -----------------------------------------------
+        result: pandas.DataFrame, 索引为(person_id_x, person_id_y)，列为jzcs、jg_num
+        """
+        month = df['adm_date'].values.astype('datetime64[D]').astype(
+            'datetime64[M]')
+        months = np.unique(month)
+        # 每人就诊次数必须大于或等于min_count
+        valid = np.bincount(df['person_id'].values) >= min_count
+        counter = PairCounter(min_count=min_count, min_jg_num=min_jg_num)
+
+        def add(left, right, org, counts, sign=1):
+            keep = valid[left] & valid[right]
+            counter.add(
+                left[keep], right[keep], org[keep],
+                complete=False, counts=sign*counts[keep])
+
+        for m in months:
+            add(*self._get_month(df[month == m], str(m)))
+
+        # 相邻月份之间的同时就诊：边界两侧就诊的全部同时就诊扣除各侧内部的同时就诊
+        time1 = time.time()
+        num_visits = 0
+        adm_time = df['adm_time'].values
+        for m1, m2 in zip(months[:-1], months[1:]):
+            in_m1 = month == m1
+            in_m2 = month == m2
+            side1 = in_m1 & (adm_time > adm_time[in_m2].min() - time_interval)
+            side2 = in_m2 & (adm_time < adm_time[in_m1].max() + time_interval)
+            if not (side1.any() and side2.any()):
+                continue
+            num_visits += side1.sum() + side2.sum()
+            add(*self.count_covisits(df[side1 | side2]))
+            add(*self.count_covisits(df[side1]), sign=-1)
+            add(*self.count_covisits(df[side2]), sign=-1)
+        logger.info('boundary visits: {}, elapse {:.3f}s'.format(
+            num_visits, time.time() - time1))
+        return counter.to_frame()
+
+    def _get_month(self, df, month):
+        """
+        读取或计算单月部分结果
+        Returns:
+        -----------------------------------------------
+        left, right, org, counts: numpy.ndarray, 当前窗口编码下的同时就诊次数
+        """
+        file = os.path.join(self.path, '{}_{}.npz'.format(month, self._key(df)))
+        if os.path.exists(file):
+            result = self._load(file)
+            if result is not None:
+                logger.info('month {}: partial loaded from {}'.format(month, file))
+                return result
+
+        time1 = time.time()
+        left, right, org, counts = self.count_covisits(df)
+        self._save(file, left, right, org, counts)
+        logger.info('month {}: {} visits, {} pair-org counts, elapse {:.3f}s'.format(
+            month, len(df), len(counts), time.time() - time1))
+        return left, right, org, counts
+
+    def _key(self, df):
+        """
+        部分结果的键：单月就诊内容（与编码及行序无关）及统计参数的哈希
+        """
+        encoder = self.encoder
+        content = pd.DataFrame({
+            'person_id': encoder.person_ids[df['person_id'].values],
+            'med_type': encoder.med_types[df['med_type'].values],
+            'flx_med_org_id': encoder.org_ids[df['flx_med_org_id'].values],
+            'adm_time': df['adm_time'].values.astype(np.int64) + encoder.time_origin
+        })
+        hashes = np.sort(pd.util.hash_pandas_object(content, index=False).values)
+        digest = hashlib.sha1(repr(sorted(self.params.items())).encode())
+        digest.update(hashes.tobytes())
+        return digest.hexdigest()[:16]
+
+    def _save(self, file, left, right, org, counts):
+        """
+        以原值保存部分结果，先写临时文件再替换，避免并发读到不完整文件
+        """
+        persons = np.unique(np.concatenate([left, right]))
+        orgs = np.unique(org)
+        temp_file = '{}.{}.tmp'.format(file, os.getpid())
+        with open(temp_file, 'wb') as fp:
+            np.savez(
+                fp,
+                person_ids=self.encoder.person_ids[persons].astype(str),
+                org_ids=self.encoder.org_ids[orgs].astype(str),
+                left=np.searchsorted(persons, left).astype(np.int32),
+                right=np.searchsorted(persons, right).astype(np.int32),
+                org=np.searchsorted(orgs, org).astype(np.int32),
+                counts=counts.astype(np.int64))
+        os.replace(temp_file, file)
+
+    def _load(self, file):
+        """
+        读取部分结果并转为当前窗口编码，存在当前窗口没有的人员或机构时返回None
+        """
+        if self._person_index is None:
+            self._person_index = pd.Index(self.encoder.person_ids.astype(str))
+            self._org_index = pd.Index(self.encoder.org_ids.astype(str))
+        with np.load(file) as data:
+            persons = self._person_index.get_indexer(data['person_ids'])
+            orgs = self._org_index.get_indexer(data['org_ids'])
+            if (persons < 0).any() or (orgs < 0).any():
+                logger.warning('partial {} does not match current data'.format(file))
+                return None
+            return (
+                persons[data['left']], persons[data['right']],
+                orgs[data['org']], data['counts'])
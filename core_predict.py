@@ -1,4 +1,6 @@
+import os
 import time
+import functools
 from collections import Counter
 
 from loguru import logger
@@ -8,11 +10,23 @@ import igraph as ig
 from joblib import Parallel, delayed
 
 from db_client import DBOperator
+from core_encoding import VisitEncoder
+from core_communities import CommunityRecords
+from checkpoint_cache import CheckpointCache
+from stage_metrics import StageMetrics
+from core_pair_partials import MonthlyPairPartials
+from core_risk_pairs import (
+    sort_visits, iter_covisits, plan_batches, PairCounter, COVISIT_BYTES,
+    find_hot_buckets, split_visits, iter_hot_covisits, prune_visits)
+from kernels import prune_community
+from shared_arrays import SharedArrays, attach
+from leiden_scheduler import cluster_components, split_communities
+from utils import get_total_memory
 
 
 def run_multicard_detection(
         db_type, db_login_info, sql, start_date, end_date, admdvs,
-        **kwargs):
+        model_no=None, **kwargs):
     """
     运行卡聚集检测
     Parameters:
@@ -23,28 +37,38 @@ def run_multicard_detection(
     start_date: str, 开始日期，格式为“yyyy-mm-dd”
     end_date: str, 结束日期，格式为“yyyy-mm-dd”
     admdvs: str or None, 医保区划
+    model_no: str, 模型编号，写入各阶段运行指标
     **kwargs: help(MultiCardDetection).
 
     Return:
     --------------------------------
     result: pandas.DataFrame
     """
+    mcd = MultiCardDetection(**kwargs)
+    mcd.metrics.context.update({
+        'model_no': model_no,
+        'input_admdvs': admdvs,
+        'input_begndate': start_date,
+        'input_enddate': end_date
+    })
     # 从数据库获取数据
-    db_operator = DBOperator(db_type, db_login_info)
-    df = db_operator.read_sql(sql)
+    with mcd.metrics.stage('read') as counts:
+        db_operator = DBOperator(db_type, db_login_info)
+        df = db_operator.read_sql(sql)
+        counts['rows_out'] = len(df)
     logger.info('columns: {}'.format(df.columns))
     logger.info('shape: {}'.format(df.shape))
     if df.shape[0] == 0:
         return None
     # 卡聚集检测
-    mcd = MultiCardDetection(**kwargs)
     result = mcd.run(df)
     if result is not None:
         result['input_begndate'] = start_date
         result['input_enddate'] = end_date
         result['input_admdvs'] = admdvs
-        # group_id前添加时间戳
-        result['group_id'] = str(int(time.time())) + '_' + result['group_id']
+        # group_id前添加时间戳，预览模式再添加preview前缀
+        prefix = 'preview_' if mcd.preview else ''
+        result['group_id'] = prefix + str(int(time.time())) + '_' + result['group_id']
     return result
 
 
@@ -57,7 +81,12 @@ class MultiCardDetection:
                  min_count, min_size, max_size, min_jg_num,
                  min_person_ratio_in_subgroup, 
                  min_risk_clinic_ratio_in_group,
-                 resolution_parameter=10, n_jobs=1):
+                 resolution_parameter=10, n_jobs=1,
+                 memory_budget=None, total_memory_budget=None,
+                 hot_bucket_size=None, hot_bucket_strategy='exact',
+                 pair_partials_dir=None, leiden_warm_start_file=None,
+                 checkpoint_dir=None, checkpoint_max_size=None, preview=False,
+                 metrics_file=None):
         """
         指定时间段内进行卡聚集检测
         Parameters:
@@ -73,6 +102,28 @@ class MultiCardDetection:
         Higher resolutions lead to more smaller communities, while 
         lower resolutions lead to fewer larger communities.
         n_jobs: int, 进程数
+        memory_budget: float, 风险对生成时单进程内存预算（MB），
+            默认为total_memory_budget/n_jobs
+        total_memory_budget: float, 风险对生成时所有进程内存预算（MB），
+            默认为物理内存的一半
+        hot_bucket_size: int, 热点桶最小就诊数，同一(med_type, 机构, 时间窗口)
+            内就诊数不少于该值时单独处理，为空时不检测
+        hot_bucket_strategy: str, 热点桶处理方式：
+            exact: 精确计算，热点桶同时就诊单独分块扫描并计时；
+            skip: 热点桶就诊不参与风险对生成
+        pair_partials_dir: str, 按月风险对部分结果保存目录，为空时不使用；
+            滑动窗口中各月同时就诊只统计一次，见core_pair_partials；
+            hot_bucket_strategy为skip时不使用
+        leiden_warm_start_file: str, 社区划分热启动文件，为空时不使用；
+            粗分社区从上一窗口保存的划分（按person_id对应）开始迭代，
+            划分质量不再提高时停止，结束后保存本窗口的划分
+        checkpoint_dir: str, 阶段结果缓存目录，为空时不使用；风险对、图及社区
+            按输入数据内容及所依赖参数缓存，只修改下游阈值时直接读取，见checkpoint_cache
+        checkpoint_max_size: float, 阶段结果缓存目录大小上限（单位：MB），为空时不限制
+        preview: bool, 预览模式：以风险对图的连通分量（超出max_size的分量上反复做标签传播，
+            无法再拆分的超大社区丢弃）代替leiden社区发现，剪枝、评分及输出格式不变，结果的attrs['preview']为True
+        metrics_file: str, 各阶段运行指标（耗时、CPU时间、峰值内存、输入输出规模）
+            追加写入的JSON lines文件，为空时只记录在metrics.records中，见stage_metrics
         """
         self.time_interval = time_interval
         self.min_count = min_count
@@ -83,24 +134,67 @@ class MultiCardDetection:
         self.min_risk_clinic_ratio_in_group = min_risk_clinic_ratio_in_group
         self.resolution_parameter = resolution_parameter
         self.n_jobs = n_jobs
+        self.memory_budget = memory_budget
+        self.total_memory_budget = total_memory_budget
+        self.hot_bucket_size = hot_bucket_size
+        self.hot_bucket_strategy = hot_bucket_strategy
+        self.pair_partials_dir = pair_partials_dir
+        self.leiden_warm_start_file = leiden_warm_start_file
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_max_size = checkpoint_max_size
+        self.preview = preview
+        self.metrics = StageMetrics(metrics_file)
 
     @staticmethod
-    def get_risk_pairs(
-            df, time_interval, 
-            min_count=0, min_jg_num=0, n_jobs=1):
+    def get_risk_pairs(df, time_interval, **kwargs):
         """
         输入数据，获取卡聚集风险对
         Parameters:
         ----------------------------------------------
         df: pandas.DataFrame
         time_interval: int, 时间间隔
+        **kwargs: 同count_pairs
+
+        Returns:
+        -----------------------------------------------
+        result: pandas.DataFrame
+        """
+        counter, person_ids, _ = MultiCardDetection.count_pairs(
+            df, time_interval, **kwargs)
+        risk_pairs = counter.to_frame()
+        del counter
+        risk_pairs.index = pd.MultiIndex.from_arrays(
+            [person_ids[risk_pairs.index.get_level_values(0)],
+             person_ids[risk_pairs.index.get_level_values(1)]],
+            names=['person_id_x', 'person_id_y'])
+        return risk_pairs
+
+    @staticmethod
+    def count_pairs(
+            df, time_interval, 
+            min_count=0, min_jg_num=0, n_jobs=1,
+            memory_budget=None, total_memory_budget=None,
+            hot_bucket_size=None, hot_bucket_strategy='exact', time_origin=0):
+        """
+        输入数据，按(人员对, 机构)统计同时就诊次数
+        Parameters:
+        ----------------------------------------------
+        df: pandas.DataFrame
+        time_interval: int, 时间间隔
         min_count: int, 最小同时出现次数
         min_jg_num: int, 至少涉及机构数
         n_jobs: int, 进程数
+        memory_budget: float, 单进程内存预算（MB）
+        total_memory_budget: float, 所有进程内存预算（MB）
+        hot_bucket_size: int, 热点桶最小就诊数，为空时不检测
+        hot_bucket_strategy: str, 热点桶处理方式，exact或skip
+        time_origin: int, 编码后adm_time的时间原点，热点桶按绝对时间窗口划分
 
         Returns:
         -----------------------------------------------
-        result: pandas.DataFrame
+        counter: core_risk_pairs.PairCounter, 人员对与机构为下列编码
+        person_ids: numpy.ndarray, 人员编码对应的输入person_id
+        org_ids: numpy.ndarray, 机构编码对应的输入flx_med_org_id
         """
         # 每人就诊次数必须大于或等于min_count
         jz_counts = df['person_id'].value_counts()
@@ -108,48 +202,140 @@ class MultiCardDetection:
         df = df[df['person_id'].isin(jz_counts.index)]
         del jz_counts
 
-        # 数据按person_id分批，每次输入一批数据与完整数据对比，获取风险对
-        person_ids = sorted(df['person_id'].unique())
-        batch_size = int(1e10 * len(person_ids) / df.shape[0]**2)
-        num_batches = (len(person_ids) - 1) // batch_size + 1
-        n_jobs = min(n_jobs, num_batches)
+        # 热点桶检测
+        hot = hot_report = None
+        if hot_bucket_size:
+            hot, hot_report = find_hot_buckets(
+                df, time_interval, hot_bucket_size, time_origin=time_origin)
+
+        # 就诊记录排序编码，数据按人员编码分批，每批输出较小人员在本批次的风险对
+        visits, person_ids, org_ids = sort_visits(df, time_interval, hot=hot)
+        del df, hot
+
+        # 候选就诊不动点剪枝：不可能进入结果的就诊不参与扫描
+        num_visits = len(visits['key'])
+        visits, iterations = prune_visits(
+            visits, time_interval, len(person_ids), 
+            min_count=min_count, min_jg_num=min_jg_num)
+        logger.info('candidate pruning: visits {} -> {}, iterations: {}'.format(
+            num_visits, len(visits['key']), iterations))
+        counter = PairCounter(min_count=min_count, min_jg_num=min_jg_num)
+        if len(visits['key']) == 0:
+            return counter, person_ids, org_ids
+
+        # 热点桶就诊单独处理，其余就诊照常分批扫描；
+        # 有热点就诊的人员，其人员对在合并热点结果前不剪枝
+        hot_visits = hot_persons = None
+        if 'hot' in visits:
+            hot_visits = visits
+            visits, hot_persons = split_visits(hot_visits)
+            if hot_bucket_strategy == 'skip':
+                hot_visits = hot_persons = None
+
+        # 内存预算（MB）：默认取物理内存的一半，平均分配给各进程
+        if total_memory_budget is None:
+            total_memory = get_total_memory()
+            total_memory_budget = total_memory / 2**21 if total_memory else 8192
+        if memory_budget is None:
+            memory_budget = total_memory_budget / max(n_jobs, 1)
+        n_jobs = max(1, min(n_jobs, int(total_memory_budget // memory_budget)))
+        max_covisits = max(1, int(memory_budget * 2**20 / COVISIT_BYTES))
+        # 按各批次同时就诊扇出估计划分批次
+        batches, fanouts = plan_batches(
+            visits, time_interval, len(person_ids), max_covisits)
+        logger.info(
+            'batches: {}, max covisits per batch: {}, estimated max: {}'.format(
+                len(batches), max_covisits, max(fanouts)))
+        n_jobs = min(n_jobs, len(batches))
+        time1 = time.time()
         if n_jobs > 1:
-            risk_pairs = Parallel(n_jobs=n_jobs, verbose=50)(
-                delayed(_get_risk_pairs)(
-                    df.loc[
-                        df['person_id'].isin(person_ids[batch_size*i:batch_size*(i+1)]), 
-                        ['med_type', 'flx_med_org_id', 'person_id', 'adm_time', 'adm_time_win']
-                    ], 
-                    df.loc[
-                        df['person_id'] >= min(person_ids[batch_size*i:batch_size*(i+1)]),
-                        ['med_type', 'flx_med_org_id', 'person_id', 'adm_time', 'adm_time_win']
-                    ], 
-                    time_interval, 
-                    min_count=min_count, 
-                    min_jg_num=min_jg_num
+            # 就诊数组放入共享内存一次，各任务只传递句柄和批次区间
+            shared_arrays = dict(visits)
+            if hot_persons is not None:
+                shared_arrays['protected'] = hot_persons
+            with SharedArrays(shared_arrays, prefix='risk_pairs_') as shared:
+                risk_pairs = Parallel(n_jobs=n_jobs, verbose=50)(
+                    delayed(_get_shared_risk_pairs)(
+                        shared.handle, 
+                        time_interval, 
+                        lo, 
+                        hi,
+                        min_count=min_count, 
+                        min_jg_num=min_jg_num,
+                        max_covisits=max_covisits
+                    )
+                    for lo, hi in batches
                 )
-                for i in range(num_batches)
-            )
         else:
             risk_pairs = [
                 _get_risk_pairs(
-                    df.loc[
-                        df['person_id'].isin(person_ids[batch_size*i:batch_size*(i+1)]), 
-                        ['med_type', 'flx_med_org_id', 'person_id', 'adm_time', 'adm_time_win']
-                    ], 
-                    df.loc[
-                        df['person_id'] >= min(person_ids[batch_size*i:batch_size*(i+1)]),
-                        ['med_type', 'flx_med_org_id', 'person_id', 'adm_time', 'adm_time_win']
-                    ], 
+                    visits, 
                     time_interval, 
+                    lo, 
+                    hi,
                     min_count=min_count, 
-                    min_jg_num=min_jg_num
+                    min_jg_num=min_jg_num,
+                    max_covisits=max_covisits,
+                    protected=hot_persons
                 )
-                for i in range(num_batches)
+                for lo, hi in batches
             ]
+        normal_elapse = time.time() - time1
 
-        risk_pairs = pd.concat(risk_pairs)
-        return risk_pairs
+        # 合并各批次部分聚合结果
+        for part in risk_pairs:
+            counter.merge(part)
+        del risk_pairs
+
+        # 热点桶：以热点就诊为锚点分块扫描，部分结果不完整，合并后统一剪枝
+        if hot_visits is not None:
+            time1 = time.time()
+            for left, right, org in iter_hot_covisits(
+                    hot_visits, time_interval, max_covisits=max_covisits):
+                counter.add(left, right, org, complete=False)
+            del hot_visits
+            hot_elapse = time.time() - time1
+        else:
+            hot_elapse = 0
+        if hot_report is not None and len(hot_report) > 0:
+            logger.info(
+                'hot buckets: {}, visits: {}, est covisits: {}, strategy: {}, '
+                'elapse {:.3f}s (other buckets {:.3f}s)'.format(
+                    len(hot_report), hot_report['visits'].sum(), 
+                    hot_report['est_covisits'].sum(), hot_bucket_strategy,
+                    hot_elapse, normal_elapse))
+            logger.info('heaviest hot buckets:\n{}'.format(hot_report.head(10)))
+        return counter, person_ids, org_ids
+
+    def count_covisits(self, df, time_origin=0):
+        """
+        统计df内全部同时就诊次数，不剪枝
+        Parameters:
+        ----------------------------------------------
+        df: pandas.DataFrame, 编码后的就诊数据
+        time_origin: int, 编码后adm_time的时间原点
+
+        Returns:
+        -----------------------------------------------
+        left: numpy.ndarray, 较小人员编码
+        right: numpy.ndarray, 较大人员编码
+        org: numpy.ndarray, 机构编码
+        counts: numpy.ndarray, 同时就诊次数
+        """
+        counter, person_ids, org_ids = self.count_pairs(
+            df, 
+            self.time_interval, 
+            n_jobs=self.n_jobs,
+            memory_budget=self.memory_budget,
+            total_memory_budget=self.total_memory_budget,
+            hot_bucket_size=self.hot_bucket_size,
+            hot_bucket_strategy=self.hot_bucket_strategy,
+            time_origin=time_origin
+        )
+        keys, orgs, counts = counter.to_arrays()
+        return (
+            person_ids[keys >> 32], person_ids[keys & 0xFFFFFFFF], 
+            org_ids[orgs], counts)
 
     @staticmethod    
     def build_graphs(data, risk_pairs):
@@ -157,256 +343,404 @@ class MultiCardDetection:
         卡聚集建图
         Parameters:
         -----------------------------
-        data: pandas.DataFrame
+        data: pandas.DataFrame, 编码后的就诊数据
         risk_pairs: pandas.DataFrame, 卡聚集风险对
 
         Returns:
         ----------------------------------
-        graph: igraph.Graph
-        graph2: igraph.Graph
+        graph: igraph.Graph, 顶点按人员编码升序排列，name为人员编码
+        graph2: igraph.Graph, 前graph.vcount()个顶点与graph的人员顶点一一对应，
+            其后依次为机构和时间顶点，name为对应编码
         """
-        item_list = list(set(j for i in risk_pairs.index for j in i))
+        item_list = np.unique(np.concatenate([
+            risk_pairs.index.get_level_values(0),
+            risk_pairs.index.get_level_values(1)]))
         logger.info('nodes: {}'.format(len(item_list)))
-        pairs = risk_pairs.index
-        pairs_cnt = list(risk_pairs['jzcs'])
+        pairs = np.column_stack([
+            np.searchsorted(item_list, risk_pairs.index.get_level_values(0)),
+            np.searchsorted(item_list, risk_pairs.index.get_level_values(1))])
         logger.info('edges: {}'.format(len(pairs)))
 
         # 建图1  
-        graph = ig.Graph()
-        graph.add_vertices(item_list)
-        graph.add_edges(pairs)
-        graph.es['weight'] = pairs_cnt
+        graph = ig.Graph(
+            n=len(item_list), 
+            edges=pairs.tolist(),
+            vertex_attrs={'name': item_list.tolist()},
+            edge_attrs={'weight': risk_pairs['jzcs'].tolist()})
         logger.info('Graph1: nodes {}, edges {}'.format(
             graph.vcount(), graph.ecount()))
 
-        temp = data[data['person_id'].isin(item_list)][
-            ['flx_med_org_id', 'adm_date', 'person_id']]
-        # 建图2
-        graph2 = ig.Graph()
-        for i in item_list:
-            graph2.add_vertex(i, type='person')
-        for i in temp['flx_med_org_id'].unique():
-            graph2.add_vertex(str(i), type='jg')
-        for i in temp['adm_date'].unique():
-            graph2.add_vertex(str(i), type='time')   
-        edges_dict = {}
-        for row in temp.values:
-            jg = str(row[0])
-            t = str(row[1])
-            item = str(row[2])
-            if (item, jg) in edges_dict:
-                edges_dict[(item, jg)] += 1
-            else:
-                edges_dict[(item, jg)] = 1
-            if (t, item) in edges_dict:
-                edges_dict[(t, item)] += 1
-            else:
-                edges_dict[(t, item)] = 1
-        graph2.add_edges(edges_dict.keys())
-        graph2.es['weight'] = edges_dict.values()
+        temp = data[data['person_id'].isin(item_list)]
+        # 建图2（编码可能重复，顶点按序号而非name连接）：
+        # 顶点依次为人员、机构、时间，机构和时间按首次出现顺序排列；
+        # 人员-机构、时间-人员的边权为就诊次数
+        person = np.searchsorted(item_list, temp['person_id'].values)
+        jg, jg_ids = pd.factorize(temp['flx_med_org_id'])
+        t, t_ids = pd.factorize(temp['adm_date'])
+        num_persons, num_jgs = len(item_list), len(jg_ids)
+        person_jg, person_jg_cnt = np.unique(
+            person.astype(np.int64) * num_jgs + jg, return_counts=True)
+        t_person, t_person_cnt = np.unique(
+            t.astype(np.int64) * num_persons + person, return_counts=True)
+        edges = np.concatenate([
+            np.column_stack([
+                person_jg // num_jgs, 
+                num_persons + person_jg % num_jgs]),
+            np.column_stack([
+                num_persons + num_jgs + t_person // num_persons, 
+                t_person % num_persons])
+        ])
+        graph2 = ig.Graph(
+            n=num_persons + num_jgs + len(t_ids),
+            edges=edges.tolist(),
+            vertex_attrs={
+                'name': item_list.tolist() + jg_ids.tolist() + t_ids.tolist(),
+                'type': ['person'] * num_persons + ['jg'] * num_jgs 
+                    + ['time'] * len(t_ids)},
+            edge_attrs={
+                'weight': np.concatenate([person_jg_cnt, t_person_cnt]).tolist()})
         logger.info('Graph2: nodes {}, edges {}'.format(
             graph2.vcount(), graph2.ecount()))
         return graph, graph2
 
     @staticmethod
-    def community_pruning(subgraph, min_count, min_size, min_jg_num):
+    def community_pruning(persons, incidence, min_count, min_size, min_jg_num):
         """
         社区剪枝
-        :param subgraph: igraph.Graph, 图
+        :param persons: numpy.ndarray, 社区人员在graph2中的顶点序号（升序）
+        :param incidence: dict, graph2的人员×时间、人员×机构关联矩阵，见graph2_incidence
         :param min_count: int, 最小同时出现次数
         :param min_size: int, 连通分量最小尺度
         :param min_jg_num: int, 至少涉及机构数
         """
-        person_num = len(subgraph.vs.select(type='person'))
-        t_num = len(subgraph.vs.select(type='time'))
-        jg_num = len(subgraph.vs.select(type='jg'))
-        if t_num < min_count or jg_num < min_jg_num or person_num < min_size:
+        # 社区人员所在行，列重新编号为社区涉及的时间和机构（按顶点序号升序）
+        t_indptr, t_cols = _slice_rows(
+            incidence['t_indptr'], incidence['t_indices'], persons)
+        o_indptr, o_cols = _slice_rows(
+            incidence['o_indptr'], incidence['o_indices'], persons)
+        ts, t_indices = np.unique(t_cols, return_inverse=True)
+        jgs, o_indices = np.unique(o_cols, return_inverse=True)
+        if len(ts) < min_count or len(jgs) < min_jg_num or len(persons) < min_size:
             return None
+        t_indices = t_indices.astype(np.int64)
+        o_indices = o_indices.astype(np.int64)
+
         # Loop：删除度过少的时间和机构，删除时间数过少的个人
-        for i in range(1, 11):
-            last_vcount = subgraph.vcount()
-            # 删除时间数过少的个人
-            ts = set(subgraph.vs.select(type='time')['name'])
-            subgraph.delete_vertices(
-                [node['name'] for node in subgraph.vs.select(type='person') 
-                 if len(set(subgraph.vs[subgraph.neighbors(node)]['name']) & ts) < max(
-                    min_count, len(ts)*0.05*i)]
-            )
-            # 删除度过少的时间和机构
-            m = max(2, len(subgraph.vs.select(type='person')) * 0.05 * i)
-            subgraph.vs.select(type='jg', _degree_lt=m).delete()
-            subgraph.vs.select(type='time', _degree_lt=m).delete()
-            if subgraph.vcount() == last_vcount:
-                break
-
-        persons = subgraph.vs.select(type='person')
-        ts = subgraph.vs.select(type='time')
-        jgs = subgraph.vs.select(type='jg')
-        if len(ts) < min_count or len(jgs) < min_jg_num or len(persons) < min_size:
+        person_alive, time_alive, org_alive = prune_community(
+            t_indptr, t_indices, o_indptr, o_indices, 
+            len(ts), len(jgs), min_count, 10)
+        if time_alive.sum() < min_count or org_alive.sum() < min_jg_num \
+                or person_alive.sum() < min_size:
             return None
 
-        degree1 = np.mean(ts.degree())
-        degree2 = np.mean(jgs.degree())
-        degree3 = np.mean(persons.degree())
+        # 保留顶点间的度
+        t_rows = np.repeat(np.arange(len(persons)), np.diff(t_indptr))
+        o_rows = np.repeat(np.arange(len(persons)), np.diff(o_indptr))
+        t_keep = person_alive[t_rows] & time_alive[t_indices]
+        o_keep = person_alive[o_rows] & org_alive[o_indices]
+        t_degree = np.bincount(t_indices[t_keep], minlength=len(ts))
+        o_degree = np.bincount(o_indices[o_keep], minlength=len(jgs))
+        p_degree = np.bincount(t_rows[t_keep], minlength=len(persons)) \
+            + np.bincount(o_rows[o_keep], minlength=len(persons))
+
+        # 保留的时间、机构、人员以graph2顶点序号表示，见core_communities
         result = {
-            'c_times': ts['name'],
-            'c_jgids': jgs['name'],
-            'c_person_ids': persons['name'],
-            'size': len(persons),
-            'degree1': degree1,
-            'degree2': degree2,
-            'degree3': degree3
+            'times': incidence['t_vertices'][ts[time_alive]],
+            'orgs': incidence['o_vertices'][jgs[org_alive]],
+            'persons': persons[person_alive],
+            'degree1': np.mean(t_degree[time_alive]),
+            'degree2': np.mean(o_degree[org_alive]),
+            'degree3': np.mean(p_degree[person_alive])
         }
         return result
 
-    def detect_multicards(self, graph, graph2):
+    @staticmethod
+    def graph2_incidence(graph2):
         """
-        卡聚集函数
+        graph2的人员×时间、人员×机构关联矩阵（CSR）
+        Returns:
+        ----------------------------------
+        incidence: dict, 
+            t_indptr, t_indices: 人员×时间，行为人员顶点序号，列为时间序号
+            o_indptr, o_indices: 人员×机构，列为机构序号
+            t_vertices, o_vertices: 时间、机构序号对应的顶点序号（升序）
+            names: numpy.ndarray, 顶点name
+        """
+        types = np.array(graph2.vs['type'])
+        num_persons = int((types == 'person').sum())
+        # 人员顶点位于最前，时间、机构顶点重新编号
+        local = np.zeros(len(types), dtype=np.int64)
+        t_vertices = np.flatnonzero(types == 'time')
+        o_vertices = np.flatnonzero(types == 'jg')
+        local[t_vertices] = np.arange(len(t_vertices))
+        local[o_vertices] = np.arange(len(o_vertices))
+        edges = np.array(graph2.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+        person_end = edges.min(axis=1)
+        other_end = edges.max(axis=1)
+        is_time = types[other_end] == 'time'
+        t_indptr, t_indices = _incidence(
+            person_end[is_time], local[other_end[is_time]], num_persons)
+        o_indptr, o_indices = _incidence(
+            person_end[~is_time], local[other_end[~is_time]], num_persons)
+        return {
+            't_indptr': t_indptr, 
+            't_indices': t_indices,
+            'o_indptr': o_indptr, 
+            'o_indices': o_indices,
+            't_vertices': t_vertices,
+            'o_vertices': o_vertices,
+            'names': np.asarray(graph2.vs['name'])
+        }
+
+    def find_communities(self, graph, person_ids=None):
+        """
+        社区发现：连通分量分解、leiden粗分及超大社区拆分。
+        结果不依赖min_size（小于min_size的社区由detect_multicards丢弃），
+        可按graph、resolution_parameter及max_size缓存
         :param graph: igraph.Graph，卡聚集图1
-        :param graph2: igraph.Graph，卡聚集图2
+        :param person_ids: numpy.ndarray, graph各顶点对应的person_id，热启动时使用
+        :return: list of numpy.ndarray，各社区graph顶点序号
         """
-        time1 = time.time()
+        # 人员编码升序，与graph及graph2人员顶点序号一一对应
+        item_list = np.asarray(graph.vs['name'])
+        # 连通分量：不超过max_size的直接作为社区，其余分量分别聚类；
+        # 小于min_size的分量及其中的社区随后均被丢弃
+        components = [np.asarray(x) for x in graph.connected_components()]
+        communities = [x for x in components if len(x) <= self.max_size]
+        components = [x for x in components if len(x) > self.max_size]
+        logger.info('连通分量数: {}，无需聚类: {}，待聚类: {}'.format(
+            len(communities) + len(components), len(communities), len(components)))
+
         # 社区
-        communities = community_leiden(
-            graph,
-            'modularity', 
-            weights='weight', 
-            resolution_parameter=self.resolution_parameter*2, 
-            n_iterations=300)
-        communities = [x for x in communities if len(x) >= self.min_size]
+        if self.leiden_warm_start_file and person_ids is not None and components:
+            # 待聚类分量的导出子图上热启动，分辨率按子图强度占比缩放，目标函数与整图一致
+            vertices = np.sort(np.concatenate(components))
+            strength = np.asarray(graph.strength(weights='weight'))
+            temp1, membership = community_leiden_warm_start(
+                graph.subgraph(vertices.tolist()),
+                load_membership(self.leiden_warm_start_file, person_ids[vertices]),
+                resolution_parameter=self.resolution_parameter * 2 
+                * strength[vertices].sum() / strength.sum(), 
+                max_iterations=300)
+            save_membership(
+                self.leiden_warm_start_file, person_ids[vertices], membership)
+            temp1 = [np.searchsorted(item_list, x) for x in temp1]
+        else:
+            temp1 = cluster_components(
+                graph,
+                components,
+                resolution_parameter=self.resolution_parameter*2,
+                n_jobs=self.n_jobs,
+                n_iterations=300)
+        communities.extend(temp1)
+        del components, temp1
         logger.info('社区数(粗分): {}'.format(len(communities)))    
 
-        # 分解大社区
+        # 分解大社区：超大社区按边数从大到小调度，拆分结果仍超出时立即重新调度
         temp1 = [x for x in communities if len(x) > self.max_size]
         communities = [x for x in communities if len(x) <= self.max_size]       
-        while len(temp1) > 0:
-            if self.n_jobs <= 1 or len(temp1) <= 20:
-                temp2 = []
-                for x in temp1:
-                    temp3 = community_leiden(
-                        graph.subgraph(x),
-                        'modularity', 
-                        weights='weight', 
-                        resolution_parameter=self.resolution_parameter, 
-                        n_iterations=300)
-                    temp2.extend([x for x in temp3 if len(x) >= self.min_size])
-                    del temp3
+        communities.extend(split_communities(
+            graph, 
+            temp1, 
+            resolution_parameter=self.resolution_parameter, 
+            min_size=1, 
+            max_size=self.max_size, 
+            n_jobs=self.n_jobs,
+            n_iterations=300))
+        del temp1
+        return communities
+
+    def find_preview_communities(self, graph):
+        """
+        预览模式的社区发现：风险对图（已按min_count、min_jg_num过滤）的连通分量，
+        超出max_size的分量上反复做标签传播，标签传播无法再拆分的超大社区丢弃
+        :param graph: igraph.Graph，卡聚集图1
+        :return: list of numpy.ndarray，各社区graph顶点序号
+        """
+        time1 = time.time()
+        communities = []
+        num_dropped = 0
+        queue = [np.asarray(x) for x in graph.connected_components()]
+        while queue:
+            x = queue.pop(0)
+            if len(x) <= self.max_size:
+                communities.append(x)
+                continue
+            clusters = graph.subgraph(x.tolist()).community_label_propagation(
+                weights='weight')
+            if len(clusters) > 1:
+                queue.extend(x[y] for y in clusters)
             else:
-                with Parallel(
-                        n_jobs=min(self.n_jobs, len(temp1)//20), 
-                        batch_size=20, 
-                        pre_dispatch='40*n_jobs', 
-                        verbose=50) as parallel:
-                    temp2 = parallel(
-                        delayed(community_leiden)(
-                            graph.subgraph(x),
-                            'modularity', 
-                            weights='weight', 
-                            resolution_parameter=self.resolution_parameter, 
-                            n_iterations=300
-                        ) for x in temp1
-                    )
-                temp2 = [x for x1 in temp2 for x in x1 if len(x) >= self.min_size]
+                num_dropped += 1
+        logger.info('preview: {} communities, {} oversized dropped, elapse {:.3f}s'.format(
+            len(communities), num_dropped, time.time() - time1))
+        return communities
 
-            temp1 = [x for x in temp2 if len(x) > self.max_size]
-            communities.extend([x for x in temp2 if len(x) <= self.max_size])
-            del temp2
+    def detect_multicards(self, graph, graph2, person_ids=None, communities=None):
+        """
+        卡聚集函数
+        :param graph: igraph.Graph，卡聚集图1
+        :param graph2: igraph.Graph，卡聚集图2
+        :param person_ids: numpy.ndarray, graph各顶点对应的person_id，热启动时使用
+        :param communities: list of numpy.ndarray, find_communities的结果，为空时计算
+        """
+        time1 = time.time()
+        if communities is None:
+            with self.metrics.stage(
+                    'leiden', vertices_in=graph.vcount(), edges_in=graph.ecount(),
+                    preview=self.preview) as counts:
+                if self.preview:
+                    communities = self.find_preview_communities(graph)
+                else:
+                    communities = self.find_communities(graph, person_ids)
+                counts['communities_out'] = len(communities)
+        communities = [x for x in communities if len(x) >= self.min_size]
 
-        # del temp1
         logger.info('社区数(细分): {}'.format(len(communities)))
         logger.info('社区长度分布：{}'.format(
             sorted(Counter(list(map(len, communities))).items(),
                    key=lambda x: x[0], reverse=True)))
 
-        # 社区剪枝
-        result = []
-        for x in communities:
-            # 取出个人相关时间和机构
-            neighbors = list(set(j for i in x for j in graph2.neighbors(i)))
-            neighbors = list(graph2.vs[neighbors]['name'])
-            subgraph2 = graph2.subgraph(x+neighbors)
-            # ig.summary(subgraph2)
-            temp = self.community_pruning(
-                subgraph2, 
-                min_count=self.min_count, 
-                min_size=self.min_size, 
-                min_jg_num=self.min_jg_num)
-            if temp:
-                result.append(temp)
-
-        # 风险分
-        for r in result:
-            subgraph2 = graph.subgraph(r['c_person_ids'])
-            r['connectivity'] = subgraph2.is_connected()
-            r['degree4'] = np.mean(subgraph2.degree())
-        result = pd.DataFrame(result)
-
-        def cal_score(x):
-            y = x['connectivity'] \
-                + (x['degree1'] + x['degree2'] + x['degree3']) * 0.1 \
-                + x['degree4'] / x['size']
-            return y
-
-        if len(result) > 0:
-            result['score'] = result.apply(cal_score, axis=1)
-            result.sort_values(['score'], ascending=False, inplace=True)
-            result = result.iloc[:10000]
-        print('结果：\n{}'.format(result))
+        # 社区剪枝：在graph2关联矩阵上取社区人员所在行
+        with self.metrics.stage('pruning', communities_in=len(communities)) as counts:
+            result = self._prune_and_rank(graph, graph2, communities)
+            counts['communities_out'] = len(result)
+        logger.info('结果：{}个社区'.format(len(result)))
         logger.info('elapse {:.0f}s'.format(time.time()-time1))
         return result 
 
-    def convert_result_to_long(self, result):
-        """
-        将结果转换为长表：一行拆多行
-        """
-        result2 = []
-        i = 0
-        for _, row in result.iterrows():
-            i += 1
-            temp2 = row.to_dict()
-            c_times = temp2.pop('c_times')
-            c_jgids = temp2.pop('c_jgids')
-            c_person_ids = temp2.pop('c_person_ids')
-            for j1 in c_times:
-                for j2 in c_jgids:
-                    for j3 in c_person_ids:
-                        temp3 = temp2.copy()
-                        temp3['adm_date'] = j1
-                        temp3['flx_med_org_id'] = j2
-                        temp3['person_id'] = j3
-                        result2.append(temp3)
-        result2 = pd.DataFrame(result2)
-        result2['adm_date'] = result2['adm_date'].astype(str)
-        result2['person_id'] = result2['person_id'].astype(str)
-        return result2  
+    def _prune_and_rank(self, graph, graph2, communities):
+        """
+        社区剪枝、评分，按风险分取前10000个社区
+        """
+        arrays = self.graph2_incidence(graph2)
+        communities = [np.sort(x) for x in communities]
+        kwargs = {
+            'min_count': self.min_count, 
+            'min_size': self.min_size, 
+            'min_jg_num': self.min_jg_num
+        }
+        # 社区较少时进程启动开销大于收益，直接计算
+        if self.n_jobs <= 1 or len(communities) <= 1000:
+            records = _prune_communities(arrays, communities, **kwargs)
+        else:
+            # 只读数组放入共享内存一次，社区按序分块，结果按块顺序合并
+            chunks = np.array_split(
+                np.arange(len(communities)), 
+                min(self.n_jobs * 4, len(communities)))
+            with SharedArrays(arrays, prefix='communities_') as shared:
+                records = Parallel(n_jobs=self.n_jobs, verbose=50)(
+                    delayed(_get_shared_prune_communities)(
+                        shared.handle, 
+                        [communities[i] for i in chunk], 
+                        **kwargs)
+                    for chunk in chunks
+                )
+            records = CommunityRecords.concat(records)
+
+        # 风险分：在graph的边表上一次性计算全部社区，只有前10000个社区转为列表
+        if len(records) > 0:
+            records.score(*_adjacency(graph))
+            index = pd.Series(records.scores).sort_values(ascending=False).index
+            result = records.to_frame(arrays['names'], index.values[:10000])
+        else:
+            result = pd.DataFrame()
+        return result
+
+    def resolve_members(self, result, df):
+        """
+        选取各组人员在组内机构、日期的就诊，不展开时间×机构×人员的组合；
+        结果（含行序）与各组按时间×机构×人员展开为长表后按['person_id', 
+        'flx_med_org_id', 'adm_date']内连接就诊数据相同，计算量与组内人员的就诊数成正比
+        Parameters:
+        --------------------------------
+        result: pandas.DataFrame, 每组一行，c_times、c_jgids、c_person_ids为编码列表
+        df: pandas.DataFrame, 编码后的就诊数据
+
+        Returns:
+        --------------------------------
+        result: pandas.DataFrame, 每个匹配的就诊一行
+        """
+        lists = {
+            'adm_date': 'c_times', 
+            'flx_med_org_id': 'c_jgids', 
+            'person_id': 'c_person_ids'
+        }
+        # 各列表首尾相接：所属组、组内位置及编码
+        groups, positions, values = {}, {}, {}
+        for column, c in lists.items():
+            lengths = result[c].map(len).values.astype(np.int64)
+            groups[column] = np.repeat(np.arange(len(result)), lengths)
+            positions[column] = np.arange(lengths.sum()) \
+                - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            values[column] = np.asarray(
+                [x for items in result[c] for x in items], dtype=np.int64)
+
+        # 按人员编码索引就诊（同一人员内保持原行序），取各组人员的全部就诊
+        person = df['person_id'].values
+        order = np.argsort(person, kind='stable')
+        lo = np.searchsorted(person[order], values['person_id'], 'left')
+        counts = np.searchsorted(person[order], values['person_id'], 'right') - lo
+        starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+        rows = order[starts + np.arange(counts.sum())]
+        group = np.repeat(groups['person_id'], counts)
+        keys = {'person_id': np.repeat(positions['person_id'], counts)}
+
+        # 就诊的机构、日期须在组内，查找其在组内列表中的位置
+        keep = np.ones(len(rows), dtype=bool)
+        for column in ('adm_date', 'flx_med_org_id'):
+            visit_values = df[column].values[rows].astype(np.int64)
+            low = min(visit_values.min(initial=0), values[column].min(initial=0))
+            span = max(visit_values.max(initial=0), values[column].max(initial=0)) \
+                - low + 1
+            found, idx = _lookup(
+                groups[column] * span + values[column] - low, 
+                group * span + visit_values - low)
+            keep &= found
+            keys[column] = positions[column][idx] if found.any() else idx
+        rows, group = rows[keep], group[keep]
+
+        # 行序同展开后内连接：组、时间、机构、人员，同一组合内按就诊原行序
+        order = np.lexsort((
+            rows, keys['person_id'][keep], keys['flx_med_org_id'][keep], 
+            keys['adm_date'][keep], group))
+        rows, group = rows[order], group[order]
+
+        result2 = {
+            c: result[c].values[group] 
+            for c in result.columns if c not in lists.values()}
+        for column in lists:
+            result2[column] = df[column].values[rows].astype(np.int64)
+        for c in df.columns:
+            if c not in lists:
+                result2[c] = df[c].values[rows]
+        return pd.DataFrame(result2)
 
     def filter_risk_groups(self, result):
         """
         风险组筛选
         """
-        result3 = []
-        for _, group in result.groupby('group_id'):
-            group_persons_num = group['person_id'].nunique()
-            subgroups = []
-            subgroup_id = 0
-            risk_clinic_ratio = 0
-            for _, subgroup in group.groupby(['flx_med_org_id', 'adm_date']):
-                # 风险子组人数占比大于阈值
-                person_ratio = subgroup['person_id'].nunique()/group_persons_num
-                if person_ratio >= self.min_person_ratio_in_subgroup:
-                    subgroup_id += 1
-                    subgroup = subgroup.copy()
-                    subgroup['subgroup_id'] = str(subgroup_id)
-                    subgroups.append(subgroup)
-                    risk_clinic_ratio += subgroup.shape[0]
-            risk_clinic_ratio /= group.shape[0]
-            # 风险就诊人次占比大于阈值
-            if risk_clinic_ratio >= self.min_risk_clinic_ratio_in_group:
-                subgroups = pd.concat(subgroups)
-                subgroups['risk_clinic_ratio'] = risk_clinic_ratio
-                result3.append(subgroups)
-        if result3:
-            result3 = pd.concat(result3)
+        # 子组为组内同一机构、同一日期的就诊
+        keys = ['group_id', 'flx_med_org_id', 'adm_date']
+        group_persons_num = result.groupby('group_id')['person_id'].transform('nunique')
+        subgroup_persons_num = result.groupby(keys)['person_id'].transform('nunique')
+        # 风险子组人数占比大于阈值
+        result3 = result[
+            subgroup_persons_num / group_persons_num >= self.min_person_ratio_in_subgroup]
+        # 风险就诊人次占比大于阈值
+        risk_clinic_ratio = result3.groupby('group_id').size() \
+            / result.groupby('group_id').size()
+        risk_clinic_ratio = risk_clinic_ratio[
+            risk_clinic_ratio >= self.min_risk_clinic_ratio_in_group]
+        result3 = result3[result3['group_id'].isin(risk_clinic_ratio.index)]
+        if len(result3) > 0:
+            # 按组、机构、日期排列（同一子组内保持原行序），子组在组内从1编号
+            result3 = result3.sort_values(keys, kind='stable')
+            subgroup_id = result3.groupby(keys).ngroup()
+            subgroup_id -= subgroup_id.groupby(result3['group_id']).transform('min') - 1
+            result3 = result3.assign(
+                subgroup_id=subgroup_id.astype(str),
+                risk_clinic_ratio=risk_clinic_ratio.reindex(result3['group_id']).values)
             result3 = result3[[
                 'group_id', 'risk_clinic_ratio', 'subgroup_id', 
                 'person_id', 'med_clinic_id',  
@@ -414,7 +748,9 @@ class MultiCardDetection:
             ]]     
         else:
             result3 = None
-        print('调整后结果：\n{}'.format(result3))
+        logger.info('调整后结果：{}行，{}个风险组'.format(
+            0 if result3 is None else len(result3),
+            0 if result3 is None else result3['group_id'].nunique()))
         return result3
 
     def run(self, df):
@@ -426,35 +762,78 @@ class MultiCardDetection:
             'admdvs','med_clinic_id','person_id','med_type','flx_med_org_id',
             'adm_time', 'adm_date']
         """
-        # 时间窗口编号
-        if 'adm_time_win' not in df.columns:
-            try:
-                df['adm_time_win'] = (
-                    df['adm_time'].view('int') // 1000000000) // self.time_interval
-            except Exception:
-                df['adm_time'] = pd.to_datetime(df['adm_time'])
-                df['adm_time_win'] = (
-                    df['adm_time'].view('int') // 1000000000) // self.time_interval
-        
-        df['adm_date'] = df['adm_date'].astype('str')
-
-        # 获取卡聚集风险对
-        risk_pairs = self.get_risk_pairs(
-            df, 
-            self.time_interval, 
-            min_count=self.min_count, 
-            min_jg_num=self.min_jg_num, 
-            n_jobs=self.n_jobs
-        )
+        # 字典编码，各阶段均在整数编码上计算
+        with self.metrics.stage('encode', rows_in=len(df)) as counts:
+            encoder = VisitEncoder()
+            df = encoder.encode(df)
+            counts['persons_out'] = len(encoder.person_ids)
 
-        # 建图
-        graph, graph2 = self.build_graphs(df, risk_pairs)
-        del risk_pairs
+        # 阶段结果缓存：键为输入数据内容及各阶段所依赖参数的哈希
+        cache = None
+        if self.checkpoint_dir:
+            cache = CheckpointCache(self.checkpoint_dir, self.checkpoint_max_size)
+            pairs_key = cache.key(
+                cache.data_key(encoder, df), self.time_interval, self.min_count, 
+                self.min_jg_num, self.hot_bucket_size, self.hot_bucket_strategy)
+            graphs_key = cache.key(pairs_key)
+            communities_key = cache.key(
+                graphs_key, self.resolution_parameter, self.max_size)
+            with self.metrics.stage('graphs_checkpoint') as counts:
+                arrays = cache.load('graphs', graphs_key)
+                counts['hit'] = arrays is not None
+                if arrays is not None:
+                    graph, graph2 = _graphs_from_arrays(arrays)
+                    counts.update(_graph_counts(graph, graph2))
+            if arrays is None:
+                graph, graph2 = self._build_graphs_cached(df, encoder, cache, pairs_key)
+                cache.save('graphs', graphs_key, _graphs_to_arrays(graph, graph2))
+        else:
+            graph, graph2 = self._build_graphs_cached(df, encoder)
+
+        # 社区：使用热启动时依赖上一窗口的划分，不缓存；预览模式不缓存
+        communities = None
+        if cache is not None and not self.leiden_warm_start_file and not self.preview:
+            with self.metrics.stage(
+                    'leiden', vertices_in=graph.vcount(), edges_in=graph.ecount(),
+                    preview=False) as counts:
+                arrays = cache.load('communities', communities_key)
+                counts['cached'] = arrays is not None
+                if arrays is not None:
+                    communities = np.split(arrays['vertices'], arrays['offsets'][1:-1]) \
+                        if len(arrays['offsets']) > 1 else []
+                else:
+                    communities = self.find_communities(graph)
+                    # 没有风险对的窗口社区为空，同样缓存
+                    cache.save('communities', communities_key, {
+                        'vertices': np.concatenate(
+                            [np.zeros(0, dtype=np.int64)] + communities).astype(np.int64),
+                        'offsets': np.cumsum([0] + [len(x) for x in communities])})
+                counts['communities_out'] = len(communities)
 
         # 卡聚集检测
-        result = self.detect_multicards(graph, graph2)
-        del graph, graph2
-        
+        result = self.detect_multicards(
+            graph, graph2,
+            person_ids=encoder.person_ids[np.asarray(graph.vs['name'], dtype=np.int64)],
+            communities=communities)
+        del graph, graph2, communities
+        result = self.postprocess(result, df, encoder)
+        if result is not None:
+            result.attrs['preview'] = self.preview
+        return result
+
+    def postprocess(self, result, df, encoder):
+        """
+        检测结果转为长表，关联挂号表，筛选风险组并解码
+        Parameters:
+        --------------------------------
+        result: pandas.DataFrame, detect_multicards的结果
+        df: pandas.DataFrame, 编码后的就诊数据
+        encoder: core_encoding.VisitEncoder, 编码器
+
+        Returns:
+        --------------------------------
+        result: pandas.DataFrame or None
+        """
         if len(result) == 0:
             return None
 
@@ -462,93 +841,265 @@ class MultiCardDetection:
         result['group_id'] = list(map(str, range(1, len(result)+1)))
         result = result[['group_id', 'c_times', 'c_jgids', 'c_person_ids']]
 
-        # 转换为长表：一行拆多行
-        result = self.convert_result_to_long(result)
-        # 关联挂号表
-        temp = df[df['person_id'].isin(result['person_id'].unique())]
-        temp = temp[
-            temp['flx_med_org_id'].isin(result['flx_med_org_id'].unique())]
-        result['adm_date'] = result['adm_date'].astype(str)
-        result['person_id'] = result['person_id'].astype(str)
-        result = result.merge(
-            temp, 
-            how='inner', 
-            on=['person_id', 'flx_med_org_id', 'adm_date'])
+        # 关联挂号表：按人员直接选取各组人员在组内机构、日期的就诊
+        with self.metrics.stage('long_conversion', groups_in=len(result)) as counts:
+            result = self.resolve_members(result, df)
+            counts['rows_out'] = len(result)
 
         # 风险组筛选
-        result = self.filter_risk_groups(result)
+        with self.metrics.stage('filter', rows_in=len(result)) as counts:
+            result = self.filter_risk_groups(result)
+            counts['rows_out'] = 0 if result is None else len(result)
+            counts['groups_out'] = 0 if result is None else result['group_id'].nunique()
+        # 解码
+        if result is not None:
+            result = encoder.decode(result)
         return result
 
+    def _build_graphs_cached(self, df, encoder, cache=None, pairs_key=None):
+        """
+        获取风险对并建图，风险对优先从缓存读取
+        """
+        with self.metrics.stage('pairs', rows_in=len(df)) as counts:
+            arrays = cache.load('pairs', pairs_key) if cache is not None else None
+            counts['cached'] = arrays is not None
+            if arrays is not None:
+                risk_pairs = _pairs_from_arrays(arrays)
+            else:
+                risk_pairs = self.compute_risk_pairs(df, encoder)
+            if cache is not None and arrays is None:
+                cache.save('pairs', pairs_key, _pairs_to_arrays(risk_pairs))
+            counts['pairs_out'] = len(risk_pairs)
+
+        # 建图
+        with self.metrics.stage('graphs', pairs_in=len(risk_pairs), cached=False) as counts:
+            graph, graph2 = self.build_graphs(df, risk_pairs)
+            counts.update(_graph_counts(graph, graph2))
+        del risk_pairs
+        return graph, graph2
+
+    def compute_risk_pairs(self, df, encoder):
+        """
+        按当前参数获取风险对，设置pair_partials_dir时由按月部分结果合并；
+        热点桶策略为skip时，跳过的就诊取决于整个窗口（按min_count筛选人员后）各桶的就诊数，
+        按月部分结果无法与直接计算一致，不使用部分结果
+        Parameters:
+        --------------------------------
+        df: pandas.DataFrame, 编码后的就诊数据
+        encoder: core_encoding.VisitEncoder, 编码器
+
+        Returns:
+        --------------------------------
+        risk_pairs: pandas.DataFrame, 见get_risk_pairs
+        """
+        skip_hot = self.hot_bucket_size and self.hot_bucket_strategy == 'skip'
+        if self.pair_partials_dir and skip_hot:
+            logger.warning('pair partials disabled: hot_bucket_strategy is skip')
+        if self.pair_partials_dir and not skip_hot:
+            params = {'time_interval': self.time_interval}
+            partials = MonthlyPairPartials(
+                self.pair_partials_dir, encoder,
+                functools.partial(self.count_covisits, time_origin=encoder.time_origin),
+                params)
+            risk_pairs = partials.get_risk_pairs(
+                df, 
+                self.time_interval, 
+                min_count=self.min_count, 
+                min_jg_num=self.min_jg_num)
+        else:
+            risk_pairs = self.get_risk_pairs(
+                df, 
+                self.time_interval, 
+                min_count=self.min_count, 
+                min_jg_num=self.min_jg_num, 
+                n_jobs=self.n_jobs,
+                memory_budget=self.memory_budget,
+                total_memory_budget=self.total_memory_budget,
+                hot_bucket_size=self.hot_bucket_size,
+                hot_bucket_strategy=self.hot_bucket_strategy,
+                time_origin=encoder.time_origin
+            )
+        return risk_pairs
+
 
 def _get_risk_pairs(
-        df_batch, df_all, time_interval, 
-        min_count=0, min_jg_num=0):
+        visits, time_interval, lo, hi,
+        min_count=0, min_jg_num=0, max_covisits=None, protected=None):
     """
-    输入数据，获取卡聚集风险对
+    输入排序后的就诊数组，获取较小人员编码在[lo, hi]内的卡聚集风险对
     Parameters:
     ----------------------------------------------
-    df_batch: pandas.DataFrame, df_all的一部分
-    df_all: pandas.DataFrame
+    visits: dict, core_risk_pairs.sort_visits的输出
     time_interval: int, 时间间隔
+    lo: int, 本批次人员编码下限（含）
+    hi: int, 本批次人员编码上限（含）
     min_count: int, 最小同时出现次数
     min_jg_num: int, 至少涉及机构数
+    max_covisits: int, 单块同时就诊数上限，超出时按人员分块扫描
+    protected: numpy.ndarray, 不提前剪枝的人员编码，见PairCounter
 
     Returns:
     -----------------------------------------------
-    result: pandas.DataFrame
+    result: core_risk_pairs.PairCounter, 已剪枝的部分聚合结果
     """
-    # 相同时间窗口直接merge
-    df_pairs = df_batch.merge(
-        df_all, 
-        how='inner', 
-        on=['med_type', 'flx_med_org_id', 'adm_time_win']
-    )[['person_id_x', 'person_id_y', 'flx_med_org_id']]
-    df_pairs = df_pairs[df_pairs['person_id_x'] < df_pairs['person_id_y']]
-    
-    # 不同时间窗口但时间差小于阈值
-    # 左边时间窗口小1
-    df_batch['adm_time_win'] = df_batch['adm_time_win'] + 1
-    temp = df_batch.merge(
-        df_all, 
-        how='inner', 
-        on=['med_type', 'flx_med_org_id', 'adm_time_win'])
-    temp = temp.loc[
-        (temp['person_id_x'] < temp['person_id_y']) & (
-            temp['adm_time_y']-temp['adm_time_x']).map(
-                lambda x: x.seconds < time_interval),
-        ['person_id_x', 'person_id_y', 'flx_med_org_id']
-    ]
-    df_pairs = pd.concat([df_pairs, temp], ignore_index=True)
-    del temp
-    
-    # 左边时间窗口大1（注：因前面加了1，所以这里要减2）
-    df_batch['adm_time_win'] = df_batch['adm_time_win'] - 2
-    temp = df_batch.merge(
-        df_all, 
-        how='inner', 
-        on=['med_type', 'flx_med_org_id', 'adm_time_win'])
-    temp = temp.loc[
-        (temp['person_id_x'] < temp['person_id_y']) & (
-            temp['adm_time_x']-temp['adm_time_y']).map(
-                lambda x: x.seconds < time_interval),
-        ['person_id_x', 'person_id_y', 'flx_med_org_id']
-    ]
-    df_pairs = pd.concat([df_pairs, temp], ignore_index=True)
-    del temp
-    
-    result = df_pairs.groupby(['person_id_x', 'person_id_y']).agg(
-        jzcs=pd.NamedAgg('flx_med_org_id', 'count'),
-        jg_num=pd.NamedAgg('flx_med_org_id', 'nunique')
-    )
-    
-    if min_count and min_jg_num:
-        result = result[
-            (result['jzcs'] >= min_count) & (result['jg_num'] >= min_jg_num)]
-    elif min_count:
-        result = result[result['jzcs'] >= min_count]
-    elif min_jg_num:
-        result = result[result['jg_num'] >= min_jg_num]
-    return result
+    # 逐块折叠同时就诊，块内人员对已完整，折叠时即剪枝
+    counter = PairCounter(
+        min_count=min_count, min_jg_num=min_jg_num, protected=protected)
+    for left, right, org in iter_covisits(
+            visits, time_interval, lo, hi, max_covisits=max_covisits):
+        counter.add(left, right, org)
+    return counter
+
+
+def _get_shared_risk_pairs(handle, *args, **kwargs):
+    """
+    子进程任务：按句柄挂载共享就诊数组后获取风险对，参数同_get_risk_pairs
+    """
+    arrays = attach(handle)
+    return _get_risk_pairs(
+        arrays, *args, protected=arrays.get('protected'), **kwargs)
+
+
+def _prune_communities(
+        arrays, communities, min_count=0, min_size=0, min_jg_num=0):
+    """
+    社区剪枝
+    Parameters:
+    ----------------------------------------------
+    arrays: dict, MultiCardDetection.graph2_incidence的输出
+    communities: list of numpy.ndarray, 各社区人员顶点序号（升序）
+    min_count, min_size, min_jg_num: 同MultiCardDetection.community_pruning
+
+    Returns:
+    -----------------------------------------------
+    result: CommunityRecords, 按社区顺序排列的剪枝结果
+    """
+    result = []
+    for persons in communities:
+        r = MultiCardDetection.community_pruning(
+            persons, arrays, 
+            min_count=min_count, min_size=min_size, min_jg_num=min_jg_num)
+        if r:
+            result.append(r)
+    return CommunityRecords.from_list(result)
+
+
+def _get_shared_prune_communities(handle, *args, **kwargs):
+    """
+    子进程任务：按句柄挂载共享数组后剪枝，参数同_prune_communities
+    """
+    return _prune_communities(attach(handle), *args, **kwargs)
+
+
+def _pairs_to_arrays(risk_pairs):
+    """
+    风险对转为数组，用于缓存
+    """
+    return {
+        'person_id_x': risk_pairs.index.get_level_values(0).values,
+        'person_id_y': risk_pairs.index.get_level_values(1).values,
+        'jzcs': risk_pairs['jzcs'].values,
+        'jg_num': risk_pairs['jg_num'].values
+    }
+
+
+def _pairs_from_arrays(arrays):
+    """
+    由_pairs_to_arrays的输出还原风险对
+    """
+    return pd.DataFrame(
+        {'jzcs': arrays['jzcs'], 'jg_num': arrays['jg_num']},
+        index=pd.MultiIndex.from_arrays(
+            [arrays['person_id_x'], arrays['person_id_y']],
+            names=['person_id_x', 'person_id_y']))
+
+
+def _graphs_to_arrays(graph, graph2):
+    """
+    graph、graph2转为边表数组，用于缓存；顶点name均为整数编码
+    """
+    arrays = {}
+    for prefix, g in (('g', graph), ('g2', graph2)):
+        arrays[prefix + '_edges'] = np.array(
+            g.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+        arrays[prefix + '_weight'] = np.asarray(g.es['weight'], dtype=np.int64)
+        arrays[prefix + '_names'] = np.asarray(g.vs['name'], dtype=np.int64)
+    arrays['g2_types'] = np.asarray(graph2.vs['type'])
+    return arrays
+
+
+def _graphs_from_arrays(arrays):
+    """
+    由_graphs_to_arrays的输出还原graph、graph2
+    """
+    graphs = []
+    for prefix in ('g', 'g2'):
+        vertex_attrs = {'name': arrays[prefix + '_names'].tolist()}
+        if prefix == 'g2':
+            vertex_attrs['type'] = arrays['g2_types'].tolist()
+        graphs.append(ig.Graph(
+            n=len(arrays[prefix + '_names']),
+            edges=arrays[prefix + '_edges'].tolist(),
+            vertex_attrs=vertex_attrs,
+            edge_attrs={'weight': arrays[prefix + '_weight'].tolist()}))
+    logger.info('Graph1: nodes {}, edges {}; Graph2: nodes {}, edges {}'.format(
+        graphs[0].vcount(), graphs[0].ecount(), graphs[1].vcount(), graphs[1].ecount()))
+    return graphs
+
+
+def _graph_counts(graph, graph2):
+    """
+    graph、graph2的顶点数及边数，记入运行指标
+    """
+    return {
+        'graph_vertices': graph.vcount(), 'graph_edges': graph.ecount(),
+        'graph2_vertices': graph2.vcount(), 'graph2_edges': graph2.ecount()
+    }
+
+
+def _adjacency(graph):
+    """
+    无向图的邻接矩阵（CSR，每条边正反各一次）
+    """
+    edges = np.array(graph.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+    return _incidence(
+        np.concatenate([edges[:, 0], edges[:, 1]]),
+        np.concatenate([edges[:, 1], edges[:, 0]]), 
+        graph.vcount())
+
+
+def _incidence(rows, cols, n_rows):
+    """
+    (行, 列)边表转为CSR：indptr, indices（行内按列升序）
+    """
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+    return indptr, cols[order].astype(np.int64)
+
+
+def _lookup(keys, queries):
+    """
+    在keys（无需有序）中查找queries，返回是否找到及在keys中的位置
+    """
+    if len(keys) == 0:
+        return np.zeros(len(queries), dtype=bool), np.zeros(len(queries), dtype=np.int64)
+    sorter = np.argsort(keys)
+    idx = sorter[np.minimum(
+        np.searchsorted(keys, queries, sorter=sorter), len(keys) - 1)]
+    return keys[idx] == queries, idx
+
+
+def _slice_rows(indptr, indices, rows):
+    """
+    取CSR中的若干行，返回新的indptr, indices
+    """
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    new_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(counts, out=new_indptr[1:])
+    offsets = np.arange(new_indptr[-1]) - np.repeat(new_indptr[:-1], counts)
+    return new_indptr, indices[np.repeat(starts, counts) + offsets]
 
 
 def community_leiden(graph, *args, **kwargs):
@@ -557,4 +1108,84 @@ def community_leiden(graph, *args, **kwargs):
     """
     result = graph.community_leiden(*args, **kwargs)
     result = [graph.vs[x]['name'] for x in result]
-    return result
\ No newline at end of file
+    return result
+
+
+def community_leiden_warm_start(
+        graph, initial_membership, resolution_parameter, max_iterations=300):
+    """
+    从initial_membership开始逐次迭代leiden，划分质量不再提高时停止
+    Parameters:
+    ----------------------------------------------
+    graph: igraph.Graph, 带weight边属性的图
+    initial_membership: list, 各顶点初始社区编号，为空时从单点社区开始
+    resolution_parameter: float, 分辨率
+    max_iterations: int, 最大迭代次数
+
+    Returns:
+    -----------------------------------------------
+    communities: list, 各社区各成员的name
+    membership: list, 各顶点社区编号
+    """
+    time1 = time.time()
+    best = None
+    membership = initial_membership
+    for iterations in range(1, max_iterations + 1):
+        partition = graph.community_leiden(
+            'modularity', 
+            weights='weight', 
+            resolution_parameter=resolution_parameter, 
+            n_iterations=1,
+            initial_membership=membership)
+        if best is not None and partition.quality <= best.quality:
+            break
+        best = partition
+        membership = partition.membership
+    elapse = time.time() - time1
+    logger.info(
+        'leiden warm start: {} iterations, quality {:.6f}, elapse {:.3f}s, '
+        'estimated saving {:.3f}s against {} iterations'.format(
+            iterations, best.quality, elapse, 
+            elapse / iterations * (max_iterations - iterations), max_iterations))
+    communities = [graph.vs[x]['name'] for x in best]
+    return communities, best.membership
+
+
+def load_membership(file, person_ids):
+    """
+    读取上一窗口的社区划分，按person_id对应到当前顶点，
+    新出现的人员各自成为单点社区；文件不存在时返回None
+    Parameters:
+    ----------------------------------------------
+    file: str, 划分文件（npz）
+    person_ids: numpy.ndarray, 当前各顶点的person_id
+
+    Returns:
+    -----------------------------------------------
+    membership: list, 各顶点初始社区编号（从0连续编号）
+    """
+    if not os.path.exists(file):
+        return None
+    with np.load(file) as data:
+        previous = pd.Series(data['membership'], index=data['person_ids'])
+    labels = previous.reindex(np.asarray(person_ids).astype(str)).to_numpy(
+        dtype=np.float64, copy=True)
+    new = np.isnan(labels)
+    logger.info('leiden warm start: {} of {} persons seen in previous window'.format(
+        len(labels) - new.sum(), len(labels)))
+    start = labels[~new].max() + 1 if (~new).any() else 0
+    labels[new] = start + np.arange(new.sum())
+    return np.unique(labels, return_inverse=True)[1].tolist()
+
+
+def save_membership(file, person_ids, membership):
+    """
+    保存社区划分，先写临时文件再替换
+    """
+    temp_file = '{}.{}.tmp'.format(file, os.getpid())
+    with open(temp_file, 'wb') as fp:
+        np.savez(
+            fp, 
+            person_ids=np.asarray(person_ids).astype(str), 
+            membership=np.asarray(membership, dtype=np.int64))
+    os.replace(temp_file, file)
\ No newline at end of file
@@ -0,0 +1,449 @@
+"""
+core_risk_pairs.py
+卡聚集风险对生成：排序-扫描（sort-and-sweep）区间连接。
+就诊记录按(med_type, flx_med_org_id, adm_time)排序后，同一(med_type, 机构)
+内入院时间差小于time_interval的两条就诊构成一次同时就诊，每对就诊只输出一次。
+"""
+from loguru import logger
+import numpy as np
+import pandas as pd
+
+from kernels import (
+    sweep_pairs, sweep_hot_pairs, reduce_sorted, pair_stats)
+
+# 每条候选同时就诊在扫描、筛选、聚合过程中的峰值内存估计（字节）
+COVISIT_BYTES = 128
+
+
+def sort_visits(df, time_interval, hot=None):
+    """
+    就诊记录编码并按(med_type, flx_med_org_id, adm_time)排序
+    Parameters:
+    ----------------------------------------------
+    df: pandas.DataFrame, 含['med_type', 'flx_med_org_id', 'person_id', 'adm_time']，
+        adm_time为datetime或已编码的秒数
+    time_interval: int, 时间间隔（秒）
+    hot: numpy.ndarray, bool, 各行是否属于热点桶，见find_hot_buckets
+
+    Returns:
+    -----------------------------------------------
+    visits: dict, 排序后的数组：
+        key: int64, 桶编号*跨度+相对秒数，同一桶内时间差即key之差，
+            不同桶之间key之差不小于time_interval
+        person: int64, 人员编码（与person_id排序一致）
+        org: int64, 机构编码
+        hot: bool, 是否属于热点桶（仅输入hot时）
+    person_ids: numpy.ndarray, 人员编码对应的输入person_id
+    org_ids: numpy.ndarray, 机构编码对应的输入flx_med_org_id
+    """
+    person, person_ids = pd.factorize(df['person_id'], sort=True)
+    org, org_ids = pd.factorize(df['flx_med_org_id'], sort=True)
+    bucket = df.groupby(
+        ['med_type', 'flx_med_org_id'], sort=False, dropna=False
+    ).ngroup().values.astype(np.int64)
+    seconds = _to_seconds(df['adm_time'])
+    if len(seconds) > 0:
+        seconds = seconds - seconds.min()
+        span = int(seconds.max()) + time_interval + 1
+    else:
+        span = 1
+    key = bucket * span + seconds
+    order = np.argsort(key, kind='stable')
+    visits = {
+        'key': key[order],
+        'person': person[order].astype(np.int64),
+        'org': org[order].astype(np.int64)
+    }
+    if hot is not None:
+        visits['hot'] = np.asarray(hot, dtype=bool)[order]
+    return visits, np.asarray(person_ids), np.asarray(org_ids)
+
+
+def find_hot_buckets(df, time_interval, hot_bucket_size, time_origin=0):
+    """
+    查找热点桶：同一(med_type, flx_med_org_id, 时间窗口)内就诊数不少于
+    hot_bucket_size的桶，此类桶内同时就诊数随就诊数平方增长
+    Parameters:
+    ----------------------------------------------
+    df: pandas.DataFrame, 同sort_visits
+    time_interval: int, 时间间隔（秒），即时间窗口宽度
+    hot_bucket_size: int, 热点桶最小就诊数
+    time_origin: int, adm_time已编码为相对秒数时的时间原点（绝对秒数，见
+        core_encoding.VisitEncoder），时间窗口按绝对时间划分，不随数据起点移动
+
+    Returns:
+    -----------------------------------------------
+    hot: numpy.ndarray, bool, 各行是否属于热点桶
+    report: pandas.DataFrame, 热点桶按估计同时就诊数降序：
+        ['med_type', 'flx_med_org_id', 'adm_time_win', 'visits', 'persons',
+         'est_covisits']，adm_time_win为绝对秒数整除time_interval
+    """
+    cells = pd.DataFrame({
+        'med_type': df['med_type'].values,
+        'flx_med_org_id': df['flx_med_org_id'].values,
+        'adm_time_win': (_to_seconds(df['adm_time']) + time_origin) // time_interval,
+        'person_id': df['person_id'].values
+    })
+    keys = ['med_type', 'flx_med_org_id', 'adm_time_win']
+    occupancy = cells.groupby(
+        keys, sort=False, dropna=False)['person_id'].transform('size').values
+    hot = occupancy >= hot_bucket_size
+    report = cells[hot].groupby(keys, dropna=False).agg(
+        visits=pd.NamedAgg('person_id', 'size'),
+        persons=pd.NamedAgg('person_id', 'nunique')
+    ).reset_index()
+    report['est_covisits'] = report['visits'] * (report['visits'] - 1) // 2
+    report = report.sort_values(
+        'est_covisits', ascending=False, ignore_index=True)
+    return hot, report
+
+
+def split_visits(visits):
+    """
+    按热点标记拆分排序后的就诊数组
+    Returns:
+    -----------------------------------------------
+    normal: dict, 非热点就诊（仍有序，可直接扫描）
+    hot_persons: numpy.ndarray, 有热点就诊的人员编码
+    """
+    mask = ~visits['hot']
+    normal = {
+        name: array[mask] for name, array in visits.items() if name != 'hot'}
+    hot_persons = np.unique(visits['person'][visits['hot']])
+    return normal, hot_persons
+
+
+def iter_hot_covisits(visits, time_interval, max_covisits=None):
+    """
+    分块输出至少一方为热点就诊的全部同时就诊。
+    以热点就诊为锚点：向后扫描全部输出，向前扫描仅输出非热点就诊，
+    保证热点-热点就诊对只输出一次；与非热点就诊之间的扫描合起来不重不漏
+    Parameters:
+    ----------------------------------------------
+    visits: dict, sort_visits的输出（须含hot）
+    time_interval: int, 时间间隔（秒）
+    max_covisits: int, 每块候选同时就诊数上限
+
+    Yields:
+    -----------------------------------------------
+    left, right, org: 同iter_covisits
+    """
+    key = visits['key']
+    person = visits['person']
+    hot = visits['hot']
+    anchors = np.flatnonzero(hot).astype(np.int64)
+    end = np.searchsorted(key, key[anchors] + time_interval, side='left')
+    start = np.searchsorted(key, key[anchors] - time_interval, side='right')
+    if max_covisits:
+        bins = _pack(end - start - 1, max_covisits)
+    else:
+        bins = [(0, len(anchors) - 1)] if len(anchors) > 0 else []
+    hot = hot.view(np.uint8)
+    for a, b in bins:
+        yield sweep_hot_pairs(
+            person, visits['org'], hot, 
+            anchors[a:b+1], start[a:b+1], end[a:b+1])
+
+
+def iter_covisits(visits, time_interval, lo, hi, max_covisits=None):
+    """
+    分块输出较小人员编码在[lo, hi]内的同时就诊。
+    块按连续人员编码划分，每块包含其人员作为较小一方的全部同时就诊，
+    块内候选同时就诊数不超过max_covisits（单人超出时单独成块）
+    Parameters:
+    ----------------------------------------------
+    visits: dict, sort_visits的输出
+    time_interval: int, 时间间隔（秒）
+    lo: int, 本批次人员编码下限（含）
+    hi: int, 本批次人员编码上限（含）
+    max_covisits: int, 每块候选同时就诊数上限，为空时不分块
+
+    Yields:
+    -----------------------------------------------
+    left: numpy.ndarray, 就诊对中较小人员编码
+    right: numpy.ndarray, 就诊对中较大人员编码
+    org: numpy.ndarray, 就诊对所在机构编码
+    """
+    key = visits['key']
+    person = visits['person']
+    pos = np.flatnonzero((person >= lo) & (person <= hi))
+    if not max_covisits or len(pos) == 0:
+        yield _sweep(visits, time_interval, pos, lo, hi)
+        return
+    pos = pos[np.argsort(person[pos], kind='stable')]
+    persons, starts = np.unique(person[pos], return_index=True)
+    stops = np.append(starts[1:], len(pos))
+    candidates = np.searchsorted(key, key[pos] + time_interval, side='left') \
+        - np.searchsorted(key, key[pos] - time_interval, side='right') - 1
+    fanout = np.add.reduceat(candidates, starts)
+    for a, b in _pack(fanout, max_covisits):
+        if a == b and fanout[a] > max_covisits:
+            logger.warning(
+                'person code {} has {} covisits, exceeding memory budget {}'.format(
+                    persons[a], fanout[a], max_covisits))
+        yield _sweep(
+            visits, time_interval, pos[starts[a]:stops[b]], persons[a], persons[b])
+
+
+def _sweep(visits, time_interval, pos, lo, hi):
+    """
+    以pos（人员编码在[lo, hi]内的全部就诊位置）为锚点扫描同时就诊
+    """
+    key = visits['key']
+    # 向后扫描：本批次就诊与其后时间差小于阈值的就诊；
+    # 向前扫描：其前就诊不在本批次且人员编码更大时，由本批次负责输出
+    end = np.searchsorted(key, key[pos] + time_interval, side='left')
+    start = np.searchsorted(key, key[pos] - time_interval, side='right')
+    return sweep_pairs(
+        visits['person'], visits['org'], pos.astype(np.int64), 
+        start, end, lo, hi)
+
+
+def _to_seconds(adm_time):
+    """
+    入院时间转为秒数，已编码为秒数时直接返回
+    """
+    if pd.api.types.is_datetime64_any_dtype(adm_time):
+        return adm_time.values.astype('datetime64[s]').astype(np.int64)
+    return adm_time.values.astype(np.int64)
+
+
+def count_neighbors(visits, time_interval):
+    """
+    每条就诊在其(med_type, 机构)桶内±time_interval邻域中的其他就诊数，
+    即该就诊可能参与的同时就诊数上限
+    Parameters:
+    ----------------------------------------------
+    visits: dict, sort_visits的输出
+    time_interval: int, 时间间隔（秒）
+
+    Returns:
+    -----------------------------------------------
+    neighbors: numpy.ndarray, int64
+    """
+    key = visits['key']
+    end = np.searchsorted(key, key + time_interval, side='left')
+    start = np.searchsorted(key, key - time_interval, side='right')
+    return end - start - 1
+
+
+def prune_visits(visits, time_interval, num_persons, min_count=0, min_jg_num=0):
+    """
+    候选就诊不动点剪枝，在生成任何同时就诊之前删除不可能进入结果的就诊，
+    反复执行直至不再变化：
+    1. 删除±time_interval邻域内没有其他人员就诊的就诊（单例）；
+    2. 删除剩余就诊的邻域就诊数之和（任一人员对同时就诊次数的上限）
+       小于min_count，或剩余就诊涉及机构数小于min_jg_num的人员的全部就诊
+    Parameters:
+    ----------------------------------------------
+    visits: dict, sort_visits的输出
+    time_interval: int, 时间间隔（秒）
+    num_persons: int, 人员数
+    min_count: int, 最小同时出现次数
+    min_jg_num: int, 至少涉及机构数
+
+    Returns:
+    -----------------------------------------------
+    visits: dict, 剪枝后的就诊数组（仍有序）
+    iterations: int, 迭代次数
+    """
+    iterations = 0
+    while len(visits['key']) > 0:
+        iterations += 1
+        key = visits['key']
+        person = visits['person']
+        # 同一人员的连续就诊为一段，左右最近的其他人员就诊即段外相邻就诊
+        change = np.flatnonzero(person[1:] != person[:-1]) + 1
+        run_start = np.concatenate([[0], change])
+        run_stop = np.concatenate([change, [len(key)]])
+        run = np.repeat(np.arange(len(run_start)), run_stop - run_start)
+        prev = run_start[run] - 1
+        after = run_stop[run]
+        shared = np.zeros(len(key), dtype=bool)
+        shared[prev >= 0] = key[prev >= 0] - key[prev[prev >= 0]] < time_interval
+        has_next = after < len(key)
+        shared[has_next] |= key[after[has_next]] - key[has_next] < time_interval
+
+        fanout = np.bincount(
+            person[shared], 
+            weights=count_neighbors(visits, time_interval)[shared],
+            minlength=num_persons)
+        num_orgs = int(visits['org'].max()) + 1
+        person_org = np.unique(
+            person[shared] * num_orgs + visits['org'][shared])
+        jg_num = np.bincount(person_org // num_orgs, minlength=num_persons)
+        alive = (fanout >= max(min_count, 1)) & (jg_num >= min_jg_num)
+        keep = shared & alive[person]
+        if keep.all():
+            break
+        visits = {name: array[keep] for name, array in visits.items()}
+    return visits, iterations
+
+
+def plan_batches(visits, time_interval, num_persons, max_covisits):
+    """
+    按内存预算划分人员批次：以各人员邻域就诊数之和估计批次的同时就诊扇出，
+    连续人员编码依次装入批次，使每批估计扇出不超过max_covisits
+    Parameters:
+    ----------------------------------------------
+    visits: dict, sort_visits的输出
+    time_interval: int, 时间间隔（秒）
+    num_persons: int, 人员数
+    max_covisits: int, 单批次同时就诊数上限
+
+    Returns:
+    -----------------------------------------------
+    batches: list of (lo, hi), 人员编码区间（含两端）
+    fanouts: list of int, 各批次估计扇出
+    """
+    fanout = np.bincount(
+        visits['person'],
+        weights=count_neighbors(visits, time_interval),
+        minlength=num_persons).astype(np.int64)
+    batches = _pack(fanout, max_covisits)
+    fanouts = [int(fanout[lo:hi+1].sum()) for lo, hi in batches]
+    return batches, fanouts
+
+
+def _pack(weights, capacity):
+    """
+    按顺序将元素装箱，每箱权重之和不超过capacity（单个元素超出时单独成箱）
+    Returns:
+    -----------------------------------------------
+    bins: list of (first, last), 各箱元素序号区间（含两端）
+    """
+    cum = np.cumsum(weights)
+    bins = []
+    first = 0
+    while first < len(weights):
+        base = cum[first-1] if first > 0 else 0
+        last = max(
+            first, int(np.searchsorted(cum, base + capacity, side='right')) - 1)
+        bins.append((first, last))
+        first = last + 1
+    return bins
+
+
+class PairCounter:
+    """
+    风险对流式部分聚合。
+    同时就诊折叠为(人员对, 机构)计数，已包含全部同时就诊的人员对在折叠时
+    即按min_count/min_jg_num剪枝，原始同时就诊不再保留；
+    各批次、各进程的部分结果通过merge合并，to_frame时统一归约。
+    """
+    def __init__(self, min_count=0, min_jg_num=0, protected=None):
+        """
+        Parameters:
+        --------------------------------
+        min_count: int, 最小同时出现次数
+        min_jg_num: int, 至少涉及机构数
+        protected: numpy.ndarray, 人员编码升序数组，涉及这些人员的人员对
+            还可能在其他部分结果中出现（如热点桶），折叠时不剪枝
+        """
+        self.min_count = min_count
+        self.min_jg_num = min_jg_num
+        self.protected = protected
+        # 部分结果：(人员对键, 机构, 次数)，按(键, 机构)排序且唯一
+        self.parts = []
+
+    def add(self, left, right, org, complete=True, counts=None):
+        """
+        折叠一批同时就诊
+        Parameters:
+        --------------------------------
+        left: numpy.ndarray, 较小人员编码
+        right: numpy.ndarray, 较大人员编码
+        org: numpy.ndarray, 机构编码
+        complete: bool, 本批是否包含所涉人员对的全部同时就诊，是则立即剪枝
+        counts: numpy.ndarray, 各行同时就诊次数（可为负，用于扣减），默认均为1
+        """
+        keys = (left.astype(np.int64) << 32) | right.astype(np.int64)
+        if counts is None:
+            counts = np.ones(len(keys), dtype=np.int64)
+        part = _reduce_pairs(keys, org.astype(np.int64), counts.astype(np.int64))
+        if complete:
+            part = self._prune(*part)
+        if len(part[0]) > 0:
+            self.parts.append(part)
+
+    def merge(self, other):
+        """
+        合并其他PairCounter的部分结果
+        """
+        self.parts.extend(other.parts)
+        return self
+
+    def to_arrays(self):
+        """
+        归约全部部分结果并剪枝
+        Returns:
+        -----------------------------------------------
+        keys: numpy.ndarray, 人员对键（较小人员编码<<32 | 较大人员编码）
+        orgs: numpy.ndarray, 机构编码
+        counts: numpy.ndarray, 同时就诊次数
+            按(keys, orgs)排序且唯一
+        """
+        if self.parts:
+            keys, orgs, counts = (
+                np.concatenate([part[i] for part in self.parts]) 
+                for i in range(3))
+        else:
+            keys = orgs = counts = np.empty(0, dtype=np.int64)
+        # 各部分键区间不重叠且按序时已有序唯一，否则重新归约
+        ordered = (keys[1:] > keys[:-1]) | (
+            (keys[1:] == keys[:-1]) & (orgs[1:] > orgs[:-1]))
+        if not ordered.all():
+            keys, orgs, counts = _reduce_pairs(keys, orgs, counts)
+        keys, orgs, counts = self._prune(keys, orgs, counts, final=True)
+        self.parts = [(keys, orgs, counts)] if len(keys) > 0 else []
+        return keys, orgs, counts
+
+    def to_frame(self):
+        """
+        归约全部部分结果并剪枝
+        Returns:
+        -----------------------------------------------
+        result: pandas.DataFrame, 索引为人员编码对(person_id_x, person_id_y)，
+            列为jzcs（同时就诊次数）、jg_num（机构数）
+        """
+        keys, orgs, counts = self.to_arrays()
+        pair_keys, jzcs, jg_num = _pair_stats(keys, counts)
+        result = pd.DataFrame(
+            {'jzcs': jzcs, 'jg_num': jg_num},
+            index=pd.MultiIndex.from_arrays(
+                [pair_keys >> 32, pair_keys & 0xFFFFFFFF],
+                names=['person_id_x', 'person_id_y']))
+        return result
+
+    def _prune(self, keys, orgs, counts, final=False):
+        """
+        删除同时就诊次数或机构数不足的人员对，非最终剪枝时保留受保护人员对
+        """
+        if not (self.min_count or self.min_jg_num):
+            return keys, orgs, counts
+        pair_keys, jzcs, jg_num = _pair_stats(keys, counts)
+        keep = (jzcs >= self.min_count) & (jg_num >= self.min_jg_num)
+        if not final and self.protected is not None and len(self.protected) > 0:
+            keep |= np.isin(pair_keys >> 32, self.protected) \
+                | np.isin(pair_keys & 0xFFFFFFFF, self.protected)
+        keep = np.repeat(keep, jg_num)
+        return keys[keep], orgs[keep], counts[keep]
+
+
+def _reduce_pairs(keys, orgs, counts):
+    """
+    按(人员对键, 机构)排序并合并计数，扣减后次数为0的(人员对, 机构)删除
+    """
+    order = np.lexsort((orgs, keys))
+    keys, orgs, counts = reduce_sorted(keys[order], orgs[order], counts[order])
+    nonzero = counts != 0
+    if not nonzero.all():
+        keys, orgs, counts = keys[nonzero], orgs[nonzero], counts[nonzero]
+    return keys, orgs, counts
+
+
+def _pair_stats(keys, counts):
+    """
+    由按键排序且(键, 机构)唯一的计数得到各人员对的同时就诊次数与机构数
+    """
+    return pair_stats(keys, counts)
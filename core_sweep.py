@@ -0,0 +1,173 @@
+"""
+core_sweep.py
+参数扫描：同一窗口数据在多组参数下运行卡聚集检测，数据只读取和编码一次。
+风险对按time_interval分组，在组内最宽松的min_count、min_jg_num下只计算一次，
+更严格的设置由风险对过滤得到（与直接计算结果一致）：去掉任一方就诊次数少于min_count的
+人员对，再按jzcs、jg_num过滤；热点桶策略为skip时，跳过的就诊取决于按min_count筛选后的
+人员，风险对改按(time_interval, min_count)分组；
+图按(time_interval, min_count, min_jg_num)共享，社区按图及resolution_parameter、
+max_size共享，min_size及风险组筛选阈值只影响剪枝和筛选。
+"""
+import time
+import inspect
+import itertools
+
+from loguru import logger
+import numpy as np
+import pandas as pd
+
+from core_encoding import VisitEncoder
+from core_predict import MultiCardDetection
+
+# 可扫描的参数，按影响的阶段从上游到下游排列
+SWEEP_PARAMS = [
+    'time_interval', 'min_count', 'min_jg_num',
+    'resolution_parameter', 'max_size',
+    'min_size', 'min_person_ratio_in_subgroup', 'min_risk_clinic_ratio_in_group'
+]
+# 各阶段耗时列，共享的阶段只在首次计算的参数组合上计时，其余为0
+STAGES = ['pairs_s', 'graphs_s', 'leiden_s', 'detect_s', 'postprocess_s']
+
+
+class ParameterSweep:
+    """
+    参数扫描，取参数网格中各参数取值的笛卡尔积
+    """
+    def __init__(self, param_grid, **kwargs):
+        """
+        Parameters:
+        --------------------------------
+        param_grid: dict, 参数名: 取值列表，参数名见SWEEP_PARAMS
+        **kwargs: 其余MultiCardDetection参数，也是未扫描参数的取值
+        """
+        unknown = set(param_grid) - set(SWEEP_PARAMS)
+        if unknown:
+            raise ValueError('unsupported sweep parameters: {}'.format(sorted(unknown)))
+        # 未扫描且未指定的参数取MultiCardDetection的默认值
+        defaults = {
+            k: v.default
+            for k, v in inspect.signature(MultiCardDetection).parameters.items()
+            if v.default is not inspect.Parameter.empty}
+        kwargs = {**defaults, **kwargs}
+        missing = set(SWEEP_PARAMS) - set(param_grid) - set(kwargs)
+        if missing:
+            raise ValueError('missing parameters: {}'.format(sorted(missing)))
+        self.param_grid = param_grid
+        self.kwargs = kwargs
+        # 各参数组合的检测结果，与combinations()顺序一致
+        self.results = []
+
+    def combinations(self):
+        """
+        全部参数组合（含未扫描参数）
+        """
+        names = list(self.param_grid)
+        return [
+            {**self.kwargs, **dict(zip(names, values))}
+            for values in itertools.product(*[self.param_grid[k] for k in names])]
+
+    def run(self, df):
+        """
+        在同一窗口数据上运行全部参数组合
+        Parameters:
+        --------------------------------
+        df: pandas.DataFrame, 输入数据，列同MultiCardDetection.run
+
+        Returns:
+        --------------------------------
+        table: pandas.DataFrame, 每个参数组合一行：扫描参数、风险组数、子组数、
+            人数、就诊数及各阶段耗时
+        """
+        time1 = time.time()
+        encoder = VisitEncoder()
+        visits = encoder.encode(df)
+        params = self.combinations()
+        logger.info('parameter sweep: {} combinations'.format(len(params)))
+
+        # 按上游参数排序，共享同一中间结果的组合相邻，中间结果只保留当前一份
+        def upstream(p, n):
+            return tuple(p[k] for k in SWEEP_PARAMS[:n])
+
+        def pairs_group(p):
+            if p['hot_bucket_size'] and p['hot_bucket_strategy'] == 'skip':
+                return upstream(p, 2)
+            return upstream(p, 1)
+
+        # 各人员就诊次数，按min_count筛选人员对
+        jz_counts = np.bincount(visits['person_id'].values)
+
+        order = sorted(range(len(params)), key=lambda i: upstream(params[i], 5))
+        rows = [None] * len(params)
+        self.results = [None] * len(params)
+        pairs_key = graphs_key = communities_key = None
+        for i in order:
+            p = params[i]
+            detector = MultiCardDetection(**p)
+            timings = dict.fromkeys(STAGES, 0.0)
+
+            # 风险对：同一time_interval下按最宽松的阈值计算一次
+            if pairs_group(p) != pairs_key:
+                pairs_key = pairs_group(p)
+                group = [q for q in params if pairs_group(q) == pairs_key]
+                loose = MultiCardDetection(**{
+                    **p,
+                    'min_count': min(q['min_count'] for q in group),
+                    'min_jg_num': min(q['min_jg_num'] for q in group)})
+                time2 = time.time()
+                risk_pairs = loose.compute_risk_pairs(visits, encoder)
+                timings['pairs_s'] = time.time() - time2
+
+            # 图：风险对按当前阈值过滤后建图，两人就诊次数均不少于min_count
+            if upstream(p, 3) != graphs_key:
+                graphs_key = upstream(p, 3)
+                time2 = time.time()
+                valid = jz_counts >= p['min_count']
+                graph, graph2 = detector.build_graphs(visits, risk_pairs[
+                    valid[risk_pairs.index.get_level_values(0).values]
+                    & valid[risk_pairs.index.get_level_values(1).values]
+                    & (risk_pairs['jzcs'] >= p['min_count'])
+                    & (risk_pairs['jg_num'] >= p['min_jg_num'])])
+                timings['graphs_s'] = time.time() - time2
+
+            # 社区：与min_size无关
+            if upstream(p, 5) != communities_key:
+                communities_key = upstream(p, 5)
+                time2 = time.time()
+                communities = detector.find_preview_communities(graph) \
+                    if detector.preview else detector.find_communities(graph)
+                timings['leiden_s'] = time.time() - time2
+
+            time2 = time.time()
+            result = detector.detect_multicards(graph, graph2, communities=communities)
+            timings['detect_s'] = time.time() - time2
+            time2 = time.time()
+            result = detector.postprocess(result, visits, encoder)
+            timings['postprocess_s'] = time.time() - time2
+
+            self.results[i] = result
+            rows[i] = {
+                **{k: p[k] for k in SWEEP_PARAMS},
+                **_summary(result),
+                **timings,
+                'total_s': sum(timings.values())
+            }
+            logger.info('combination {}/{}: {}'.format(i + 1, len(params), rows[i]))
+
+        table = pd.DataFrame(rows)
+        logger.info('parameter sweep: {} combinations, elapse {:.3f}s'.format(
+            len(params), time.time() - time1))
+        return table
+
+
+def _summary(result):
+    """
+    检测结果的风险组数、子组数、人数及就诊数
+    """
+    if result is None:
+        return {'groups': 0, 'subgroups': 0, 'persons': 0, 'clinics': 0}
+    return {
+        'groups': result['group_id'].nunique(),
+        'subgroups': len(result[['group_id', 'subgroup_id']].drop_duplicates()),
+        'persons': result['person_id'].nunique(),
+        'clinics': result['med_clinic_id'].nunique()
+    }
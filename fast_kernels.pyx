@@ -0,0 +1,198 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""
+fast_kernels.pyx
+kernels.py中计算核的Cython实现（类型化memoryview），接口与NumPy实现一致。
+开发环境编译：cythonize -i fast_kernels.pyx
+"""
+import numpy as np
+
+
+def sweep_pairs(const long long[:] person, const long long[:] org,
+                const long long[:] pos, const long long[:] start,
+                const long long[:] end, long long lo, long long hi):
+    cdef Py_ssize_t k, j, p, n = 0, m = pos.shape[0]
+    cdef long long a, b
+    # 第一遍计数，第二遍填充，不生成中间数组
+    for k in range(m):
+        p = pos[k]
+        a = person[p]
+        for j in range(p + 1, end[k]):
+            b = person[j]
+            if b >= lo and b != a:
+                n += 1
+        for j in range(start[k], p):
+            if person[j] > hi:
+                n += 1
+    left = np.empty(n, dtype=np.int64)
+    right = np.empty(n, dtype=np.int64)
+    orgs = np.empty(n, dtype=np.int64)
+    cdef long long[:] l = left
+    cdef long long[:] r = right
+    cdef long long[:] o = orgs
+    n = 0
+    for k in range(m):
+        p = pos[k]
+        a = person[p]
+        for j in range(p + 1, end[k]):
+            b = person[j]
+            if b >= lo and b != a:
+                l[n] = a if a < b else b
+                r[n] = b if a < b else a
+                o[n] = org[p]
+                n += 1
+        for j in range(start[k], p):
+            b = person[j]
+            if b > hi:
+                l[n] = a
+                r[n] = b
+                o[n] = org[p]
+                n += 1
+    return left, right, orgs
+
+
+def sweep_hot_pairs(const long long[:] person, const long long[:] org,
+                    const unsigned char[:] hot, const long long[:] pos,
+                    const long long[:] start, const long long[:] end):
+    cdef Py_ssize_t k, j, p, n = 0, m = pos.shape[0]
+    cdef long long a, b
+    for k in range(m):
+        p = pos[k]
+        a = person[p]
+        for j in range(p + 1, end[k]):
+            if person[j] != a:
+                n += 1
+        for j in range(start[k], p):
+            if not hot[j] and person[j] != a:
+                n += 1
+    left = np.empty(n, dtype=np.int64)
+    right = np.empty(n, dtype=np.int64)
+    orgs = np.empty(n, dtype=np.int64)
+    cdef long long[:] l = left
+    cdef long long[:] r = right
+    cdef long long[:] o = orgs
+    n = 0
+    for k in range(m):
+        p = pos[k]
+        a = person[p]
+        for j in range(start[k], end[k]):
+            if j == p:
+                continue
+            b = person[j]
+            if b == a or (j < p and hot[j]):
+                continue
+            l[n] = a if a < b else b
+            r[n] = b if a < b else a
+            o[n] = org[p]
+            n += 1
+    return left, right, orgs
+
+
+def reduce_sorted(const long long[:] keys, const long long[:] orgs,
+                  const long long[:] counts):
+    cdef Py_ssize_t i, n = 0, m = keys.shape[0]
+    for i in range(m):
+        if i == 0 or keys[i] != keys[i-1] or orgs[i] != orgs[i-1]:
+            n += 1
+    out_keys = np.empty(n, dtype=np.int64)
+    out_orgs = np.empty(n, dtype=np.int64)
+    out_counts = np.zeros(n, dtype=np.int64)
+    cdef long long[:] k = out_keys
+    cdef long long[:] o = out_orgs
+    cdef long long[:] c = out_counts
+    n = -1
+    for i in range(m):
+        if i == 0 or keys[i] != keys[i-1] or orgs[i] != orgs[i-1]:
+            n += 1
+            k[n] = keys[i]
+            o[n] = orgs[i]
+        c[n] += counts[i]
+    return out_keys, out_orgs, out_counts
+
+
+def pair_stats(const long long[:] keys, const long long[:] counts):
+    cdef Py_ssize_t i, n = 0, m = keys.shape[0]
+    for i in range(m):
+        if i == 0 or keys[i] != keys[i-1]:
+            n += 1
+    pair_keys = np.empty(n, dtype=np.int64)
+    jzcs = np.zeros(n, dtype=np.int64)
+    jg_num = np.zeros(n, dtype=np.int64)
+    cdef long long[:] k = pair_keys
+    cdef long long[:] c = jzcs
+    cdef long long[:] g = jg_num
+    n = -1
+    for i in range(m):
+        if i == 0 or keys[i] != keys[i-1]:
+            n += 1
+            k[n] = keys[i]
+        c[n] += counts[i]
+        g[n] += 1
+    return pair_keys, jzcs, jg_num
+
+
+def prune_community(const long long[:] t_indptr, const long long[:] t_indices,
+                    const long long[:] o_indptr, const long long[:] o_indices,
+                    Py_ssize_t n_times, Py_ssize_t n_orgs,
+                    long long min_count, int max_iter=10):
+    cdef Py_ssize_t n_persons = t_indptr.shape[0] - 1
+    cdef Py_ssize_t i, j, it, alive, last, nt, np_, c
+    cdef double thr, m
+    person_alive = np.ones(n_persons, dtype=np.uint8)
+    time_alive = np.ones(n_times, dtype=np.uint8)
+    org_alive = np.ones(n_orgs, dtype=np.uint8)
+    cdef unsigned char[:] pa = person_alive
+    cdef unsigned char[:] ta = time_alive
+    cdef unsigned char[:] oa = org_alive
+    kill = np.zeros(n_persons, dtype=np.uint8)
+    cdef unsigned char[:] kl = kill
+    t_degree = np.zeros(n_times, dtype=np.int64)
+    o_degree = np.zeros(n_orgs, dtype=np.int64)
+    cdef long long[:] td = t_degree
+    cdef long long[:] od = o_degree
+
+    alive = n_persons + n_times + n_orgs
+    for it in range(1, max_iter + 1):
+        last = alive
+        # 删除时间数过少的个人
+        nt = 0
+        for j in range(n_times):
+            nt += ta[j]
+        thr = max(<double>min_count, nt * 0.05 * it)
+        for i in range(n_persons):
+            kl[i] = 0
+            if pa[i]:
+                c = 0
+                for j in range(t_indptr[i], t_indptr[i+1]):
+                    c += ta[t_indices[j]]
+                if c < thr:
+                    kl[i] = 1
+        np_ = 0
+        for i in range(n_persons):
+            if kl[i]:
+                pa[i] = 0
+            np_ += pa[i]
+        # 删除度过少的时间和机构
+        m = max(2.0, np_ * 0.05 * it)
+        for j in range(n_times):
+            td[j] = 0
+        for j in range(n_orgs):
+            od[j] = 0
+        for i in range(n_persons):
+            if pa[i]:
+                for j in range(t_indptr[i], t_indptr[i+1]):
+                    td[t_indices[j]] += 1
+                for j in range(o_indptr[i], o_indptr[i+1]):
+                    od[o_indices[j]] += 1
+        alive = np_
+        for j in range(n_times):
+            if ta[j] and td[j] < m:
+                ta[j] = 0
+            alive += ta[j]
+        for j in range(n_orgs):
+            if oa[j] and od[j] < m:
+                oa[j] = 0
+            alive += oa[j]
+        if alive == last:
+            break
+    return (person_alive.astype(bool), time_alive.astype(bool),
+            org_alive.astype(bool))
@@ -0,0 +1,142 @@
+"""
+kernels.py
+热点循环计算核：同时就诊扫描、人员对计数归约、社区剪枝迭代。
+导入时优先使用Cython编译的fast_kernels（部署时由setup.py编译，
+开发环境可执行cythonize -i fast_kernels.pyx），未编译时使用等价的NumPy实现。
+所有整数数组均为int64。
+"""
+import numpy as np
+
+
+def py_sweep_pairs(person, org, pos, start, end, lo, hi):
+    """
+    以pos为锚点扫描同时就诊：向后[pos+1, end)内人员编码不小于lo且不同于锚点的就诊，
+    向前[start, pos)内人员编码大于hi的就诊
+    Returns:
+    -----------------------------------------------
+    left: numpy.ndarray, 较小人员编码
+    right: numpy.ndarray, 较大人员编码
+    org: numpy.ndarray, 机构编码
+    """
+    first, second = _expand(pos, pos + 1, end)
+    keep = (person[second] >= lo) & (person[second] != person[first])
+    first, second = first[keep], second[keep]
+    second2, first2 = _expand(pos, start, pos)
+    keep = person[first2] > hi
+    first = np.concatenate([first, first2[keep]])
+    second = np.concatenate([second, second2[keep]])
+    left = np.minimum(person[first], person[second])
+    right = np.maximum(person[first], person[second])
+    return left, right, org[first]
+
+
+def py_sweep_hot_pairs(person, org, hot, pos, start, end):
+    """
+    以热点就诊pos为锚点扫描同时就诊：向后[pos+1, end)全部输出，
+    向前[start, pos)仅输出非热点就诊，均排除同一人员；hot为uint8数组
+    """
+    first, second = _expand(pos, pos + 1, end)
+    second2, first2 = _expand(pos, start, pos)
+    keep = hot[first2] == 0
+    first = np.concatenate([first, first2[keep]])
+    second = np.concatenate([second, second2[keep]])
+    keep = person[first] != person[second]
+    first, second = first[keep], second[keep]
+    left = np.minimum(person[first], person[second])
+    right = np.maximum(person[first], person[second])
+    return left, right, org[first]
+
+
+def py_reduce_sorted(keys, orgs, counts):
+    """
+    已按(keys, orgs)排序的计数合并相同(keys, orgs)
+    """
+    if len(keys) == 0:
+        return keys, orgs, counts
+    flag = np.ones(len(keys), dtype=bool)
+    flag[1:] = (keys[1:] != keys[:-1]) | (orgs[1:] != orgs[:-1])
+    idx = np.flatnonzero(flag)
+    return keys[idx], orgs[idx], np.add.reduceat(counts, idx)
+
+
+def py_pair_stats(keys, counts):
+    """
+    已按keys排序且(keys, 机构)唯一的计数，得到各键的计数之和与行数
+    """
+    if len(keys) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    flag = np.ones(len(keys), dtype=bool)
+    flag[1:] = keys[1:] != keys[:-1]
+    idx = np.flatnonzero(flag)
+    jzcs = np.add.reduceat(counts, idx)
+    jg_num = np.diff(np.append(idx, len(keys)))
+    return keys[idx], jzcs, jg_num
+
+
+def py_prune_community(t_indptr, t_indices, o_indptr, o_indices,
+                       n_times, n_orgs, min_count, max_iter=10):
+    """
+    社区剪枝迭代：删除时间数过少的个人，删除度过少的时间和机构，直至不再变化
+    Parameters:
+    ----------------------------------------------
+    t_indptr, t_indices: 人员×时间关联矩阵（CSR）
+    o_indptr, o_indices: 人员×机构关联矩阵（CSR）
+    n_times: int, 时间数
+    n_orgs: int, 机构数
+    min_count: int, 最小同时出现次数
+    max_iter: int, 最大迭代次数
+
+    Returns:
+    -----------------------------------------------
+    person_alive, time_alive, org_alive: numpy.ndarray, bool, 各顶点是否保留
+    """
+    n_persons = len(t_indptr) - 1
+    t_rows = np.repeat(np.arange(n_persons), np.diff(t_indptr))
+    o_rows = np.repeat(np.arange(n_persons), np.diff(o_indptr))
+    person_alive = np.ones(n_persons, dtype=bool)
+    time_alive = np.ones(n_times, dtype=bool)
+    org_alive = np.ones(n_orgs, dtype=bool)
+    alive = n_persons + n_times + n_orgs
+    for i in range(1, max_iter + 1):
+        last = alive
+        # 删除时间数过少的个人
+        t_counts = np.bincount(
+            t_rows, weights=time_alive[t_indices], minlength=n_persons)
+        person_alive &= t_counts >= max(min_count, time_alive.sum()*0.05*i)
+        # 删除度过少的时间和机构
+        m = max(2, person_alive.sum() * 0.05 * i)
+        time_alive &= np.bincount(
+            t_indices, weights=person_alive[t_rows], minlength=n_times) >= m
+        org_alive &= np.bincount(
+            o_indices, weights=person_alive[o_rows], minlength=n_orgs) >= m
+        alive = person_alive.sum() + time_alive.sum() + org_alive.sum()
+        if alive == last:
+            break
+    return person_alive, time_alive, org_alive
+
+
+def _expand(pos, begin, end):
+    """
+    将每个位置pos[k]展开为与区间[begin[k], end[k])内各位置的配对
+    """
+    counts = np.maximum(end - begin, 0)
+    total = int(counts.sum())
+    anchor = np.repeat(pos, counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    other = np.repeat(begin, counts) + offsets
+    return anchor, other
+
+
+try:
+    from fast_kernels import (
+        sweep_pairs, sweep_hot_pairs, reduce_sorted, pair_stats,
+        prune_community)
+    HAS_FAST_KERNELS = True
+except ImportError:
+    sweep_pairs = py_sweep_pairs
+    sweep_hot_pairs = py_sweep_hot_pairs
+    reduce_sorted = py_reduce_sorted
+    pair_stats = py_pair_stats
+    prune_community = py_prune_community
+    HAS_FAST_KERNELS = False
@@ -0,0 +1,200 @@
+"""
+leiden_scheduler.py
+连通分量聚类及超大社区递归拆分调度。
+图的边表写入共享内存一次，各进程挂载后重建图，任务只传递顶点序号；
+待拆分社区按估计边数从大到小调度，拆分结果中仍超出max_size的社区立即重新入队，
+不同层级的拆分相互重叠，不必等待同一层级全部完成。
+leiden无法再拆分的超大社区（结果仍为原社区）丢弃，不再重复调度。
+各连通分量相互独立，在各分量上分别运行leiden，按分量大小从大到小并行。
+"""
+import heapq
+import itertools
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from loguru import logger
+import numpy as np
+import igraph as ig
+from joblib.externals.loky import get_reusable_executor
+
+from shared_arrays import SharedArrays, attach
+
+# 子进程内由共享边表重建的图：{目录: igraph.Graph}，仅保留最近一次
+_graphs = {}
+
+
+def cluster_components(
+        graph, components, resolution_parameter, n_jobs=1, n_iterations=300):
+    """
+    在各连通分量上分别运行leiden，每个分量的结果与单独在该分量上运行一致。
+    整图模块度按连通分量可加，分量内各顶点的强度与在整图中相同，
+    分辨率按分量强度占整图强度的比例缩放后，目标函数与在整图上运行相同
+    Parameters:
+    ----------------------------------------------
+    graph: igraph.Graph, 带weight边属性的图
+    components: list of numpy.ndarray, 待聚类连通分量的顶点序号
+    resolution_parameter: float, 整图上的分辨率
+    n_jobs: int, 进程数，不大于1时在本进程内依次聚类
+    n_iterations: int, leiden迭代次数
+
+    Returns:
+    -----------------------------------------------
+    result: list of numpy.ndarray, 各社区顶点序号（升序），按分量顺序排列
+    """
+    time1 = time.time()
+    strength = np.asarray(graph.strength(weights='weight'))
+    total = strength.sum()
+    components = [np.sort(x) for x in components]
+    resolutions = [
+        resolution_parameter * strength[x].sum() / total for x in components]
+    if n_jobs <= 1 or len(components) <= 1:
+        parts = [
+            _split(graph, x, resolution_parameter=r, n_iterations=n_iterations)
+            for x, r in zip(components, resolutions)]
+    else:
+        parts = [None] * len(components)
+        executor = get_reusable_executor(max_workers=n_jobs)
+        with SharedArrays(_graph_arrays(graph), prefix='leiden_') as shared:
+            # 大分量先提交，减少尾部等待
+            futures = {
+                executor.submit(
+                    _get_shared_split, shared.handle, components[i],
+                    resolution_parameter=resolutions[i],
+                    n_iterations=n_iterations): i
+                for i in np.argsort([-len(x) for x in components], kind='stable')}
+            for future in futures:
+                parts[futures[future]] = future.result()
+    result = [x for part in parts for x in part]
+    logger.info('leiden components: {} components, {} communities, elapse {:.3f}s'.format(
+        len(components), len(result), time.time() - time1))
+    return result
+
+
+def split_communities(
+        graph, communities, resolution_parameter, min_size, max_size,
+        n_jobs=1, n_iterations=300):
+    """
+    使用leiden算法递归拆分超过max_size的社区，直至均不超过max_size
+    Parameters:
+    ----------------------------------------------
+    graph: igraph.Graph, 带weight边属性的图
+    communities: list of numpy.ndarray, 待拆分社区的顶点序号
+    resolution_parameter: float, 拆分使用的分辨率
+    min_size: int, 社区最小尺度，更小的拆分结果丢弃
+    max_size: int, 社区最大尺度
+    n_jobs: int, 进程数，不大于1时在本进程内按先进先出顺序拆分
+    n_iterations: int, leiden迭代次数
+
+    Returns:
+    -----------------------------------------------
+    result: list of numpy.ndarray, 拆分后不超过max_size的社区顶点序号（升序）
+    """
+    time1 = time.time()
+    kwargs = {
+        'resolution_parameter': resolution_parameter,
+        'n_iterations': n_iterations
+    }
+    result = []
+    num_tasks = 0
+    if n_jobs <= 1 or len(communities) == 0:
+        # 先进先出，与逐层拆分的顺序一致
+        queue = [np.sort(x) for x in communities]
+        while queue:
+            num_tasks += 1
+            vertices = queue.pop(0)
+            for x in _split(graph, vertices, **kwargs):
+                if len(x) > max_size:
+                    if len(x) < len(vertices):
+                        queue.append(x)
+                    else:
+                        _warn_unsplittable(x)
+                elif len(x) >= min_size:
+                    result.append(x)
+    else:
+        # 按估计边数（顶点度之和的一半）从大到小调度
+        degree = np.array(graph.degree(), dtype=np.int64)
+        seq = itertools.count()
+        heap = []
+
+        def push(x):
+            heapq.heappush(heap, (-int(degree[x].sum()) // 2, next(seq), x))
+
+        for x in communities:
+            push(np.sort(x))
+        # 与joblib相同使用loky进程池：子进程不由fork产生，主进程中的日志线程等不影响子进程
+        executor = get_reusable_executor(max_workers=n_jobs)
+        with SharedArrays(_graph_arrays(graph), prefix='leiden_') as shared:
+            running = set()
+            # 任务对应的社区大小
+            tasks = {}
+            while heap or running:
+                # 空闲进程取当前最大的待拆分社区
+                while heap and len(running) < n_jobs:
+                    x = heapq.heappop(heap)[2]
+                    future = executor.submit(
+                        _get_shared_split, shared.handle, x, **kwargs)
+                    tasks[future] = len(x)
+                    running.add(future)
+                    num_tasks += 1
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    size = tasks.pop(future)
+                    for x in future.result():
+                        if len(x) > max_size:
+                            if len(x) < size:
+                                push(x)
+                            else:
+                                _warn_unsplittable(x)
+                        elif len(x) >= min_size:
+                            result.append(x)
+        # 完成顺序不确定，按最小顶点序号排列
+        result.sort(key=lambda x: x[0])
+    logger.info('leiden split: {} tasks, {} communities, elapse {:.3f}s'.format(
+        num_tasks, len(result), time.time() - time1))
+    return result
+
+
+def _graph_arrays(graph):
+    """
+    图的边表、边权及顶点数，放入共享内存供子进程重建图
+    """
+    return {
+        'edges': np.array(graph.get_edgelist(), dtype=np.int64).reshape(-1, 2),
+        'weight': np.asarray(graph.es['weight']),
+        'vcount': np.array([graph.vcount()], dtype=np.int64)
+    }
+
+
+def _warn_unsplittable(vertices):
+    """
+    记录无法拆分的超大社区
+    """
+    logger.warning('community of size {} cannot be split further, dropped'.format(
+        len(vertices)))
+
+
+def _split(graph, vertices, resolution_parameter, n_iterations):
+    """
+    在vertices（升序）的导出子图上运行leiden，返回各社区顶点序号（升序）
+    """
+    clusters = graph.subgraph(vertices.tolist()).community_leiden(
+        'modularity',
+        weights='weight',
+        resolution_parameter=resolution_parameter,
+        n_iterations=n_iterations)
+    return [vertices[x] for x in clusters]
+
+
+def _get_shared_split(handle, vertices, **kwargs):
+    """
+    子进程任务：按句柄挂载共享边表，重建图后拆分，参数同_split
+    """
+    path = handle[0]
+    if path not in _graphs:
+        arrays = attach(handle)
+        _graphs.clear()
+        _graphs[path] = ig.Graph(
+            n=int(arrays['vcount'][0]),
+            edges=np.asarray(arrays['edges']).tolist(),
+            edge_attrs={'weight': np.asarray(arrays['weight']).tolist()})
+    return _split(_graphs[path], vertices, **kwargs)
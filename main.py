@@ -1,5 +1,4 @@
 import time
-import datetime
 import multiprocessing
 import argparse
 import traceback
@@ -9,10 +8,11 @@ from pathlib import Path
 
 from loguru import logger
 import yaml
-import pandas as pd
 from db_client import DBOperator, LoggingToDb
 
 from core_multicard_detection import run_multicard_detection
+from stage_metrics import load_stage_metrics
+from result_writer import RiskGroupsWriter
 from utils import get_time_windows2
 import data_prep2 as data_prep
 from core_extract_result import extract_risk_result, RiskResultExtractor
@@ -110,102 +110,123 @@ def main(model_no, config,
         logger.info('数据预处理完成，耗时{:.3f}s'.format(time.time() - time1))
 
     logger.info("开始执行卡聚集检测...") 
-    # 每个时间窗口内，运行卡聚集函数
-    if not distributed:
-        # 非分布式
-        result = []
-        for idx, (start_date, end_date) in enumerate(time_windows):
-            logger.info('start_date: {}, end_date: {}'.format(start_date, end_date))
-            sql = sql_input_data.format(
-                output_schema=output_schema,
-                kc21_table=kc21_table,
-                start_date=start_date,
-                end_date=end_date
-            )
-            result.append(
-                run_multicard_detection(
-                    db_type,
-                    config['db_login_info'],
-                    sql,
-                    start_date,
-                    end_date,
-                    admdvs,
-                    time_interval=config['time_interval'],
-                    min_count=config['min_count'], 
-                    min_size=config['min_size'], 
-                    max_size=config['max_size'],
-                    min_jg_num=config['min_jg_num'],
-                    min_person_ratio_in_subgroup=config['min_person_ratio_in_subgroup'],
-                    min_risk_clinic_ratio_in_group=config['min_risk_clinic_ratio_in_group'],
-                    resolution_parameter=config['resolution_parameter'],
-                    n_jobs=multiprocessing.cpu_count()-1
+    # 检测结果分批写入风险组表：各时间窗口完成后即放入缓冲区，缓冲行数达到上限时插入
+    db_operator = DBOperator(db_type, config['db_login_info'])
+    writer = RiskGroupsWriter(
+        db_operator, output_schema, risk_groups_table, model_no,
+        create_sql=sql_create_risk_groups_table.format(output_schema, risk_groups_table),
+        batch_rows=config.get('result_batch_rows', 200000)
+    )
+    try:
+        # 每个时间窗口内，运行卡聚集函数
+        if not distributed:
+            # 非分布式
+            for idx, (start_date, end_date) in enumerate(time_windows):
+                logger.info('start_date: {}, end_date: {}'.format(start_date, end_date))
+                sql = sql_input_data.format(
+                    output_schema=output_schema,
+                    kc21_table=kc21_table,
+                    start_date=start_date,
+                    end_date=end_date
                 )
-            )
-            logger.info('total: {}, succeed: {}, elapse {:.3f}s'.format(
-                len(time_windows), idx+1, time.time()-time1
+                writer.write(
+                    run_multicard_detection(
+                        db_type,
+                        config['db_login_info'],
+                        sql,
+                        start_date,
+                        end_date,
+                        admdvs,
+                        time_interval=config['time_interval'],
+                        min_count=config['min_count'], 
+                        min_size=config['min_size'], 
+                        max_size=config['max_size'],
+                        min_jg_num=config['min_jg_num'],
+                        min_person_ratio_in_subgroup=config['min_person_ratio_in_subgroup'],
+                        min_risk_clinic_ratio_in_group=config['min_risk_clinic_ratio_in_group'],
+                        resolution_parameter=config['resolution_parameter'],
+                        n_jobs=multiprocessing.cpu_count()-1,
+                        memory_budget=config.get('memory_budget'),
+                        total_memory_budget=config.get('total_memory_budget'),
+                        hot_bucket_size=config.get('hot_bucket_size'),
+                        hot_bucket_strategy=config.get('hot_bucket_strategy', 'exact'),
+                        pair_partials_dir=config.get('pair_partials_dir'),
+                        leiden_warm_start_file=config.get('leiden_warm_start_file'),
+                        checkpoint_dir=config.get('checkpoint_dir'),
+                        checkpoint_max_size=config.get('checkpoint_max_size'),
+                        preview=config.get('preview', False),
+                        metrics_file=config.get('stage_metrics_file'),
+                        model_no=model_no
+                    )
+                )
+                logger.info('total: {}, succeed: {}, elapse {:.3f}s'.format(
+                    len(time_windows), idx+1, time.time()-time1
+                ))
+        else:
+            # 分布式
+            for start_date, end_date in time_windows:
+                logger.info('start_date: {}, end_date: {}'.format(start_date, end_date))
+                sql = sql_input_data.format(
+                    output_schema=output_schema,
+                    kc21_table=kc21_table,
+                    start_date=start_date,
+                    end_date=end_date
+                )
+                task_manager.submit_task(
+                    args=(db_type, config['db_login_info'], sql, start_date, end_date, admdvs,), 
+                    kwargs={
+                        'time_interval': config['time_interval'],
+                        'min_count': config['min_count'], 
+                        'min_size': config['min_size'], 
+                        'max_size': config['max_size'],
+                        'min_jg_num': config['min_jg_num'],
+                        'min_person_ratio_in_subgroup': config['min_person_ratio_in_subgroup'],
+                        'min_risk_clinic_ratio_in_group': config['min_risk_clinic_ratio_in_group'],
+                        'resolution_parameter': config['resolution_parameter'],
+                        'n_jobs': 1,
+                        'memory_budget': config.get('memory_budget'),
+                        'total_memory_budget': config.get('total_memory_budget'),
+                        'hot_bucket_size': config.get('hot_bucket_size'),
+                        'hot_bucket_strategy': config.get('hot_bucket_strategy', 'exact'),
+                        'pair_partials_dir': config.get('pair_partials_dir'),
+                        'checkpoint_dir': config.get('checkpoint_dir'),
+                        'checkpoint_max_size': config.get('checkpoint_max_size'),
+                        'preview': config.get('preview', False),
+                        'metrics_file': config.get('stage_metrics_file'),
+                        'model_no': model_no
+                    }
+                )
+
+            # 等待所有任务完成
+            time2 = time.time() 
+            logger.info('接收结果中...')   
+            result = task_manager.get_all_results(timeout=86400)
+            logger.info('结果接收完成，耗时{:.3f}s.'.format(time.time()-time2))
+            # 逐个写入，写入后即释放
+            while result:
+                writer.write(result.pop(0))
+    finally:
+        # 写入缓冲区剩余结果；后续窗口失败时，已完成窗口的结果在异常抛出前写入
+        writer.flush()
+
+    # 各阶段运行指标写入数据库（分布式运行时只包含写入本机文件的记录）
+    if config.get('stage_metrics_file') and config.get('stage_metrics_table'):
+        metrics = load_stage_metrics(config['stage_metrics_file'], model_no)
+        logger.info('stage metrics: {} records'.format(len(metrics)))
+        if len(metrics) > 0:
+            log_schema = config['db_tables']['log_schema']
+            db_operator.execute(all_sqls.create_stage_metrics_table.format(
+                log_schema, config['stage_metrics_table']
             ))
-    else:
-        # 分布式
-        for start_date, end_date in time_windows:
-            logger.info('start_date: {}, end_date: {}'.format(start_date, end_date))
-            sql = sql_input_data.format(
-                output_schema=output_schema,
-                kc21_table=kc21_table,
-                start_date=start_date,
-                end_date=end_date
+            db_operator.to_sql(
+                metrics, database=log_schema, table_name=config['stage_metrics_table']
             )
-            task_manager.submit_task(
-                args=(db_type, config['db_login_info'], sql, start_date, end_date, admdvs,), 
-                kwargs={
-                    'time_interval': config['time_interval'],
-                    'min_count': config['min_count'], 
-                    'min_size': config['min_size'], 
-                    'max_size': config['max_size'],
-                    'min_jg_num': config['min_jg_num'],
-                    'min_person_ratio_in_subgroup': config['min_person_ratio_in_subgroup'],
-                    'min_risk_clinic_ratio_in_group': config['min_risk_clinic_ratio_in_group'],
-                    'resolution_parameter': config['resolution_parameter'],
-                    'n_jobs': 1
-                }
-            )
-
-        # 等待所有任务完成
-        time2 = time.time() 
-        logger.info('接收结果中...')   
-        result = task_manager.get_all_results(timeout=86400)
-        logger.info('结果接收完成，耗时{:.3f}s.'.format(time.time()-time2))
 
-    # 结果合并，保存，后处理
-    result = [i for i in result if i is not None]
-    if not result:
+    # 后处理
+    if writer.rows == 0:
         logger.warning('No result, please adjust parameters in configuration file!')
     else:
-        result = pd.concat(result, ignore_index=True)
-        result['model_no'] = model_no
-        result['run_time'] = datetime.datetime.now()
-        result['risk_clinic_ratio'] = result['risk_clinic_ratio'].fillna(0)
-        result = result[[
-            'model_no', 'run_time', 
-            'input_admdvs', 'input_begndate', 'input_enddate', 
-            'group_id', 'subgroup_id', 'risk_clinic_ratio', 
-            'person_id', 'med_clinic_id',  
-            'flx_med_org_id', 'med_type', 'adm_date', 'adm_time'
-        ]]
-        print('结果汇总：\n{}'.format(result))
-        logger.info('result shape: {}'.format(result.shape))
-
-        # 数据库操作器
-        db_operator = DBOperator(db_type, config['db_login_info'])
-
-        # 创建结果表并保存
-        logger.info("Create result table in database...")
-        db_operator.execute(sql_create_risk_groups_table.format(
-            output_schema, risk_groups_table
-        ))
-        logger.info("Insert result into database...")
-        db_operator.to_sql(
-            result, database=output_schema, table_name=risk_groups_table
-        )
+        logger.info('result rows: {}, batches: {}'.format(writer.rows, writer.batches))
 
         # 抽取风险结果
         # extract_risk_result(
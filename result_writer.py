@@ -0,0 +1,99 @@
+"""
+result_writer.py
+风险组结果分批写入数据库。
+各时间窗口的检测结果完成后即放入缓冲区，缓冲行数达到上限时按批插入结果表，
+主进程只保留不超过一个批次的结果；已写入的窗口不受后续窗口失败的影响。
+"""
+import datetime
+
+from loguru import logger
+import pandas as pd
+
+# 风险组结果表的列
+RISK_GROUPS_COLUMNS = [
+    'model_no', 'run_time',
+    'input_admdvs', 'input_begndate', 'input_enddate',
+    'group_id', 'subgroup_id', 'risk_clinic_ratio',
+    'person_id', 'med_clinic_id',
+    'flx_med_org_id', 'med_type', 'adm_date', 'adm_time'
+]
+
+
+class RiskGroupsWriter:
+    """
+    风险组结果分批写入器：各窗口结果依次write，结束时（含后续窗口抛出异常时，
+    调用方在finally中）flush写入剩余结果
+    """
+    def __init__(self, db_operator, database, table_name, model_no,
+                 create_sql=None, batch_rows=200000):
+        """
+        Parameters:
+        --------------------------------
+        db_operator: db_client.DBOperator, 数据库操作器
+        database: str, 结果表所在库
+        table_name: str, 结果表名
+        model_no: str, 模型编号
+        create_sql: str, 建表语句，首次插入前执行
+        batch_rows: int, 每批插入的最大行数，也是缓冲区行数上限
+        """
+        self.db_operator = db_operator
+        self.database = database
+        self.table_name = table_name
+        self.model_no = model_no
+        self.create_sql = create_sql
+        self.batch_rows = batch_rows
+        # 同一次运行的结果使用相同的运行时间
+        self.run_time = datetime.datetime.now()
+        self.buffer = []
+        self.buffer_rows = 0
+        # 已写入的行数、批数
+        self.rows = 0
+        self.batches = 0
+
+    def write(self, result):
+        """
+        放入一个时间窗口的检测结果，缓冲行数达到上限时写入数据库
+        Parameters:
+        --------------------------------
+        result: pandas.DataFrame or None, run_multicard_detection的结果
+        """
+        if result is None or len(result) == 0:
+            return
+        result = result.assign(
+            model_no=self.model_no,
+            run_time=self.run_time,
+            risk_clinic_ratio=result['risk_clinic_ratio'].fillna(0)
+        )[RISK_GROUPS_COLUMNS]
+        self.buffer.append(result)
+        self.buffer_rows += len(result)
+        if self.buffer_rows >= self.batch_rows:
+            self.flush(partial=False)
+
+    def flush(self, partial=True):
+        """
+        缓冲区结果按batch_rows分批插入数据库
+        Parameters:
+        --------------------------------
+        partial: bool, 是否写入不足batch_rows的剩余结果，否则剩余结果留在缓冲区
+        """
+        if not self.buffer:
+            return
+        result = pd.concat(self.buffer, ignore_index=True)
+        end = len(result) if partial \
+            else len(result) // self.batch_rows * self.batch_rows
+        self.buffer = [result.iloc[end:].copy()] if end < len(result) else []
+        self.buffer_rows = len(result) - end
+        if end == 0:
+            return
+        if self.batches == 0 and self.create_sql:
+            logger.info("Create result table in database...")
+            self.db_operator.execute(self.create_sql)
+        for start in range(0, end, self.batch_rows):
+            self.db_operator.to_sql(
+                result.iloc[start:min(start + self.batch_rows, end)],
+                database=self.database, table_name=self.table_name
+            )
+            self.rows += min(self.batch_rows, end - start)
+            self.batches += 1
+        logger.info('result writer: {} rows written in {} batches'.format(
+            self.rows, self.batches))
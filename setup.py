@@ -44,6 +44,7 @@ sources = ['./']
 compiling_exclude_files = [
     "./data_prep2.py",
     "./main.py", 
+    "./sweep.py",
     "./distributed_worker.py"
 ]
 
@@ -52,7 +53,7 @@ compiling_exclude_files = [
 # 可使用"**/filename"表示任意文件夹下的"filename"文件
 files_not_copy = [
     './.old', './old', './log',                                 
-    './saved', './others', './tests'
+    './saved', './others', './tests', './benchmarks'
 ]
 
 # 检查格式是否符合要求
@@ -159,7 +160,7 @@ for source in sources:
     os.chdir(source)  # 切换路径
     # 扫描py
     for p in Path('./').glob('**/*'): 
-        if p.suffix not in ('.py', '.pyc'):
+        if p.suffix not in ('.py', '.pyc', '.pyx'):
             continue
         if p.name in ('__init__.py', 'setup.py'):
             continue
@@ -0,0 +1,66 @@
+"""
+shared_arrays.py
+进程间共享只读numpy数组。
+数组以列式.npy文件写入临时目录（优先使用内存文件系统/dev/shm）一次，
+子进程凭句柄以内存映射方式挂载，任务参数只需传递句柄，不再逐任务序列化数据。
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# 子进程内已挂载的数组：{目录: {列名: numpy.memmap}}，仅保留最近一次挂载
+_attached = {}
+
+
+class SharedArrays:
+    """
+    共享数组，可用作上下文管理器，退出时删除临时文件
+    """
+    def __init__(self, arrays, prefix='shared_arrays_'):
+        """
+        Parameters:
+        --------------------------------
+        arrays: dict, {列名: numpy.ndarray}
+        prefix: str, 临时目录前缀
+        """
+        root = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=root)
+        for name, array in arrays.items():
+            np.save(os.path.join(self.path, name + '.npy'), array)
+        # 句柄：(目录, 列名)，可直接作为任务参数传递
+        self.handle = (self.path, tuple(arrays))
+
+    def close(self):
+        """
+        删除临时文件（已挂载的子进程映射在其关闭前仍然有效）
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def attach(handle):
+    """
+    按句柄挂载共享数组（只读内存映射），同一进程内重复挂载时直接复用
+    Parameters:
+    --------------------------------
+    handle: tuple, SharedArrays.handle
+
+    Returns:
+    --------------------------------
+    arrays: dict, {列名: numpy.memmap}
+    """
+    path, names = handle
+    if path not in _attached:
+        _attached.clear()
+        _attached[path] = {
+            name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+            for name in names
+        }
+    return _attached[path]
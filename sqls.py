@@ -92,6 +92,23 @@ class HiveSqls:
         adm_time timestamp
     )
     """
+    # 创建各阶段运行指标表
+    create_stage_metrics_table = """create table if not exists {}.{}(
+        model_no string,
+        input_admdvs string,
+        input_begndate string,
+        input_enddate string,
+        time string,
+        pid bigint,
+        stage string,
+        status string,
+        wall_s double,
+        cpu_s double,
+        peak_rss_mb double,
+        peak_rss_delta_mb double,
+        counts string
+    )
+    """
     # 创建风险就诊结果表
     create_risk_clinic_table = """CREATE TABLE if not exists {risk_clinic_table} (
         model_no string,
@@ -388,6 +405,23 @@ class MaxComputeSqls:
         adm_time timestamp
     )
     """
+    # 创建各阶段运行指标表
+    create_stage_metrics_table = """create table if not exists {}.{}(
+        model_no string,
+        input_admdvs string,
+        input_begndate string,
+        input_enddate string,
+        time string,
+        pid bigint,
+        stage string,
+        status string,
+        wall_s double,
+        cpu_s double,
+        peak_rss_mb double,
+        peak_rss_delta_mb double,
+        counts string
+    )
+    """
     # 创建风险就诊结果表
     create_risk_clinic_table = """CREATE TABLE if not exists {risk_clinic_table} (
         model_no string,
@@ -696,6 +730,24 @@ class ClickhouseSqls:
     ) engine=MergeTree()
     order by tuple()
     """
+    # 创建各阶段运行指标表
+    create_stage_metrics_table = """create table if not exists {}.{} (
+        model_no String,
+        input_admdvs Nullable(String),
+        input_begndate String,
+        input_enddate String,
+        time String,
+        pid Int64,
+        stage String,
+        status String,
+        wall_s Float64,
+        cpu_s Float64,
+        peak_rss_mb Float64,
+        peak_rss_delta_mb Float64,
+        counts String
+    ) engine=MergeTree()
+    order by tuple()
+    """
     # 创建风险就诊结果表
     create_risk_clinic_table = """CREATE TABLE if not exists {risk_clinic_table} (
         model_no String,
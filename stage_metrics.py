@@ -0,0 +1,197 @@
+"""
+stage_metrics.py
+分阶段运行指标。
+记录卡聚集各阶段（读数、风险对、建图、社区发现、剪枝评分、成员关联、风险组筛选等）的
+耗时、CPU时间、阶段内峰值内存及其增量、输入输出规模，
+以JSON lines追加写入文件，并可按model_no汇总写入数据库。
+CPU时间为本进程及阶段内已结束（已回收）子进程的时间之和，
+常驻的进程池（joblib/loky、ProcessPoolExecutor）worker的CPU时间不计入。
+"""
+import os
+import json
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+
+from loguru import logger
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# 阶段内常驻内存采样间隔（秒）
+SAMPLE_INTERVAL = 0.05
+# 写入数据库的固定列，其余字段（输入输出规模等）以JSON字符串存入counts列
+DB_COLUMNS = [
+    'model_no', 'input_admdvs', 'input_begndate', 'input_enddate',
+    'time', 'pid', 'stage', 'status',
+    'wall_s', 'cpu_s', 'peak_rss_mb', 'peak_rss_delta_mb'
+]
+
+
+class StageMetrics:
+    """
+    分阶段运行指标记录器
+    """
+    def __init__(self, path=None, **context):
+        """
+        Parameters:
+        --------------------------------
+        path: str, JSON lines文件路径，为空时只记录在records中
+        **context: 每条记录附带的上下文，如model_no、input_admdvs、
+            input_begndate、input_enddate
+        """
+        self.path = path
+        self.context = context
+        self.records = []
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    @contextmanager
+    def stage(self, name, **counts):
+        """
+        记录一个阶段，with块内可向返回的字典写入输入输出规模，例如：
+            with metrics.stage('pairs', rows_in=len(df)) as counts:
+                ...
+                counts['rows_out'] = len(risk_pairs)
+        阶段内抛出异常时，记录的status为error。
+        peak_rss_mb为阶段内采样到的本进程常驻内存最大值，peak_rss_delta_mb为其与阶段开始时
+        常驻内存之差；无法读取/proc/self/statm时，二者退化为进程生命周期内的峰值及其增量
+        """
+        counts = dict(counts)
+        wall1 = time.perf_counter()
+        cpu1 = _cpu_time()
+        sampler = _RssSampler()
+        sampler.start()
+        status = 'ok'
+        try:
+            yield counts
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            cpu2 = _cpu_time()
+            peak1, peak2 = sampler.stop()
+            record = {
+                'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                'pid': os.getpid(),
+                **self.context,
+                'stage': name,
+                'status': status,
+                'wall_s': round(time.perf_counter() - wall1, 6),
+                'cpu_s': round(cpu2 - cpu1, 6),
+                'peak_rss_mb': round(peak2, 1),
+                'peak_rss_delta_mb': round(peak2 - peak1, 1),
+                **{k: v.item() if hasattr(v, 'item') else v for k, v in counts.items()}
+            }
+            self.records.append(record)
+            logger.info('stage {}: wall {:.3f}s, cpu {:.3f}s, peak rss {:.1f}MB (+{:.1f}MB), {}'.format(
+                name, record['wall_s'], record['cpu_s'], record['peak_rss_mb'],
+                record['peak_rss_delta_mb'], counts))
+            if self.path:
+                with open(self.path, 'a', encoding='utf-8') as fp:
+                    fp.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+
+def load_stage_metrics(path, model_no):
+    """
+    读取JSON lines文件中model_no的记录，转为写入数据库的格式
+    Parameters:
+    --------------------------------
+    path: str, JSON lines文件路径
+    model_no: str, 模型编号
+
+    Returns:
+    --------------------------------
+    result: pandas.DataFrame, 列为DB_COLUMNS及counts
+    """
+    records = []
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('model_no') == model_no:
+                    records.append(record)
+    result = pd.DataFrame(
+        [{k: r.get(k) for k in DB_COLUMNS} for r in records], columns=DB_COLUMNS)
+    result['counts'] = [
+        json.dumps({k: v for k, v in r.items() if k not in DB_COLUMNS},
+                   ensure_ascii=False, default=str)
+        for r in records]
+    return result
+
+
+class _RssSampler:
+    """
+    后台线程按SAMPLE_INTERVAL采样本进程当前常驻内存，记录阶段内最大值
+    """
+    def __init__(self):
+        self.start_rss = self.peak_rss = _current_rss()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.start_rss is None:
+            # 无/proc时使用进程峰值常驻内存
+            self.start_rss = _max_rss()
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            self.peak_rss = max(self.peak_rss, _current_rss() or 0)
+
+    def stop(self):
+        """
+        停止采样
+
+        Returns:
+        --------------------------------
+        start_rss: float, 阶段开始时常驻内存（MB）
+        peak_rss: float, 阶段内常驻内存最大值（MB）
+        """
+        if self._thread is None:
+            return self.start_rss, _max_rss()
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, _current_rss() or 0)
+        return self.start_rss, self.peak_rss
+
+
+def _current_rss():
+    """
+    本进程当前常驻内存（MB），无法读取/proc/self/statm时返回None
+    """
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def _max_rss():
+    """
+    本进程生命周期内峰值常驻内存（MB）
+    """
+    if resource is None:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def _cpu_time():
+    """
+    本进程及已回收子进程的CPU时间（秒）
+    """
+    if resource is None:
+        return time.process_time()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
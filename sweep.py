@@ -0,0 +1,158 @@
+"""
+sweep.py
+卡聚集参数扫描：读取一个时间窗口的数据，在参数网格的全部组合下运行检测，
+输出各组合的风险组数及各阶段耗时对照表。
+参数网格为yaml文件，参数名: 取值列表，例如：
+    min_count: [2, 3, 4]
+    min_jg_num: [1, 2]
+    resolution_parameter: [5, 10]
+    min_size: [3, 5]
+用法：
+    python sweep.py -c config.yaml --grid grid.yaml --start_date 2021-01-01 --end_date 2021-03-31
+输入数据取自数据预处理生成的临时挂号表，未运行过数据预处理时加--run_data_prep 1。
+"""
+import time
+import multiprocessing
+import argparse
+from pathlib import Path
+
+from loguru import logger
+import yaml
+import pandas as pd
+from db_client import DBOperator
+
+from core_sweep import ParameterSweep
+import data_prep2 as data_prep
+import sqls
+
+
+def sweep(config, param_grid, start_date, end_date, admdvs=None, run_data_prep=False):
+    """
+    参数扫描主函数
+    Parameters:
+    ----------------
+    config: dict, 配置字典
+    param_grid: dict, 参数网格，见core_sweep.ParameterSweep
+    start_date: str, 开始日期，格式为'YYYY-MM-DD'
+    end_date: str, 结束日期，格式为'YYYY-MM-DD'
+    admdvs: str, 医保区划，默认不限医保区划
+    run_data_prep: bool, 是否运行数据预处理
+
+    Returns:
+    ----------------
+    table: pandas.DataFrame, 参数组合对照表
+    """
+    time1 = time.time()
+    output_schema = config['db_tables']['output_schema']
+    kc21_table = config['temp_kc21_table']
+    if admdvs is not None and admdvs.strip().lower() not in ('', 'all', 'null', 'none'):
+        kc21_table += '_{}'.format(admdvs)
+
+    db_type = config['db_login_info']['type'].lower().strip()
+    assert db_type in ('clickhouse', 'hive', 'odps')
+    if db_type == 'hive':
+        all_sqls = sqls.HiveSqls()
+    elif db_type == 'odps':
+        all_sqls = sqls.MaxComputeSqls()
+    else:
+        all_sqls = sqls.ClickhouseSqls()
+
+    # 数据预处理
+    if run_data_prep:
+        logger.info("开始数据预处理...")
+        data_prep.run(config, start_date=start_date, end_date=end_date, admdvs=admdvs)
+        logger.info('数据预处理完成，耗时{:.3f}s'.format(time.time() - time1))
+
+    # 读取一次数据，全部参数组合共用
+    sql = all_sqls.select_input_data.format(
+        output_schema=output_schema,
+        kc21_table=kc21_table,
+        start_date=start_date,
+        end_date=end_date
+    )
+    df = DBOperator(db_type, config['db_login_info']).read_sql(sql)
+    logger.info('shape: {}, elapse {:.3f}s'.format(df.shape, time.time() - time1))
+    if df.shape[0] == 0:
+        logger.warning('No input data between {} and {}'.format(start_date, end_date))
+        return None
+
+    param_sweep = ParameterSweep(
+        param_grid,
+        time_interval=config['time_interval'],
+        min_count=config['min_count'],
+        min_size=config['min_size'],
+        max_size=config['max_size'],
+        min_jg_num=config['min_jg_num'],
+        min_person_ratio_in_subgroup=config['min_person_ratio_in_subgroup'],
+        min_risk_clinic_ratio_in_group=config['min_risk_clinic_ratio_in_group'],
+        resolution_parameter=config['resolution_parameter'],
+        n_jobs=multiprocessing.cpu_count()-1,
+        memory_budget=config.get('memory_budget'),
+        total_memory_budget=config.get('total_memory_budget'),
+        hot_bucket_size=config.get('hot_bucket_size'),
+        hot_bucket_strategy=config.get('hot_bucket_strategy', 'exact'),
+        pair_partials_dir=config.get('pair_partials_dir')
+    )
+    table = param_sweep.run(df)
+    logger.info('参数扫描完成，耗时{:.3f}s'.format(time.time() - time1))
+    return table
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument(
+        "-c", "--config_file", type=str, default='config.yaml',
+        help="配置文件路径"
+    )
+    arg_parser.add_argument(
+        "--grid", type=str, required=True, help="参数网格yaml文件路径"
+    )
+    arg_parser.add_argument(
+        "--admdvs", type=str, help="医保区划，默认从配置文件获取"
+    )
+    arg_parser.add_argument(
+        "--start_date", type=str,
+        help="开始日期，格式为“YYYY-MM-DD”或“YYYYMMDD”"
+    )
+    arg_parser.add_argument(
+        "--end_date", type=str,
+        help="结束日期，格式为“YYYY-MM-DD”或“YYYYMMDD”"
+    )
+    arg_parser.add_argument(
+        "--run_data_prep", type=int, default=0,
+        help="是否运行数据预处理程序？ 0.否（默认），1.是。"
+    )
+    arg_parser.add_argument(
+        "--output", type=str, default='sweep_result.csv', help="对照表csv路径"
+    )
+    args = arg_parser.parse_args()
+
+    # 读取配置文件
+    with open(args.config_file, encoding='utf-8') as config_file:
+        config = yaml.safe_load(config_file)
+    config.update(config['params']['rsk_crd_gtr'])
+    with open(args.grid, encoding='utf-8') as grid_file:
+        param_grid = yaml.safe_load(grid_file)
+
+    log_file = Path(config['log_file']).expanduser().resolve()
+    if not log_file.parent.exists():
+        log_file.parent.mkdir(parents=True)
+    logger.add(
+        log_file,
+        backtrace=True, diagnose=True,
+        rotation='1 days', retention='2 months',
+        enqueue=True
+    )
+    logger.info('命令行参数：{}'.format(args))
+
+    table = sweep(
+        config,
+        param_grid,
+        start_date=args.start_date,
+        end_date=args.end_date,
+        admdvs=args.admdvs,
+        run_data_prep=args.run_data_prep)
+    if table is not None:
+        with pd.option_context('display.max_columns', None, 'display.width', 200):
+            print('参数扫描结果：\n{}'.format(table))
+        table.to_csv(args.output, index=False)
@@ -1,3 +1,4 @@
+import os
 import multiprocessing
 import functools
 import datetime
@@ -76,6 +77,21 @@ def get_time_windows2(start_date, end_date, window_size, step_size):
     return time_windows
 
 
+def get_total_memory():
+    """
+    物理内存总量（字节），无法获取时返回None
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().total
+    except ImportError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
 def with_timeout(timeout):
     """
     timeout装饰器